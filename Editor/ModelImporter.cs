@@ -61,6 +61,7 @@ public class ModelImporter {
 		var configJson = AssetDatabase.LoadAssetAtPath<TextAsset>(Path.Join(folder, "config.json"));
 		var tokenizerJson = AssetDatabase.LoadAssetAtPath<TextAsset>(Path.Join(folder, "tokenizer.json"));
 		var testcaseJson = AssetDatabase.LoadAssetAtPath<TextAsset>(Path.Join(folder, "testcase.json"));
+		var aliasesJson = AssetDatabase.LoadAssetAtPath<TextAsset>(Path.Join(folder, "aliases.json"));
 		var config = JsonUtility.FromJson<Config>(configJson.text);
 		var model_type = config.model_type;
 		Debug.Log($"{folder} : {model_type}");
@@ -82,6 +83,7 @@ public class ModelImporter {
 			vits.configJson = configJson;
 			vits.tokenizerJson = tokenizerJson;
 			vits.testcaseJson = testcaseJson;
+			vits.aliasesJson = aliasesJson;
 			return vits;
 		} else {
 			var go = new GameObject(Path.GetFileName(folder), typeof(BasicLM));
@@ -91,6 +93,7 @@ public class ModelImporter {
 			lm.configJson = configJson;
 			lm.tokenizerJson = tokenizerJson;
 			lm.testcaseJson = testcaseJson;
+			lm.aliasesJson = aliasesJson;
 			return lm;
 		}
 	}
@@ -170,7 +173,38 @@ public class ModelImporter {
 		}
 		if(path.EndsWith(".png"))
 			return TextureImporterFormat.RGBA32;
-		return dtype == DataType.Float16 ? TextureImporterFormat.RGBAHalf : TextureImporterFormat.RGBAFloat;
+		return dtype == DataType.Float16 || IsHalfExr(path) ? TextureImporterFormat.RGBAHalf : TextureImporterFormat.RGBAFloat;
+	}
+	static bool IsHalfExr(string path) {
+		// tensors planned as float16 are saved as half exr, keep them half even when the model uses float32
+		if(!path.EndsWith(".exr"))
+			return false;
+		using(var reader = new BinaryReader(File.OpenRead(path))) {
+			if(reader.ReadInt32() != 20000630)
+				return false;
+			reader.ReadInt32();
+			string ReadString() {
+				var sb = new System.Text.StringBuilder();
+				for(char c; (c = (char)reader.ReadByte()) != 0; )
+					sb.Append(c);
+				return sb.ToString();
+			}
+			for(string name; (name = ReadString()) != ""; ) {
+				var type = ReadString();
+				var size = reader.ReadInt32();
+				if(type != "chlist") {
+					reader.BaseStream.Seek(size, SeekOrigin.Current);
+					continue;
+				}
+				var half = false;
+				while(ReadString() != "") {
+					half = reader.ReadInt32() == 1; // pixel type: 0 uint, 1 half, 2 float
+					reader.ReadBytes(12);
+				}
+				return half;
+			}
+		}
+		return false;
 	}
 	static string[] GetTexturePaths(string folder) {
 		return AssetDatabase.FindAssets("t:Texture", new string[]{folder}).Select(
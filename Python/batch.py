@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+import shlex
+import hashlib
+import argparse
+import io
+import contextlib
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import torch
+import convert
+
+# job file: one convert.py command line per line, for example
+#   roneneldan/TinyStories-1M ../Model/
+#   roneneldan/TinyStories-1M ../Model/q8/ --quantize 1
+# empty lines and lines starting with # are ignored. jobs of the same model run in one process and share the loaded model
+
+def read_jobs(path):
+	with open(path, encoding="utf-8") as f:
+		lines = [x.strip() for x in f]
+	return list(dict.fromkeys(x for x in lines if x and not x.startswith("#"))) # drop duplicate jobs
+
+def job_id(job):
+	return hashlib.sha1(job.encode()).hexdigest()[:12]
+
+def model_key(args):
+	# arguments that change the loaded model. jobs differing in other arguments (e.g. --quantize) reuse it
+	return (args.model, args.tokenizer, args.device, args.dtype, args.trust, args.stream)
+
+def group_key(job):
+	try:
+		with contextlib.redirect_stderr(io.StringIO()):
+			return model_key(convert.parse_args(shlex.split(job)))
+	except SystemExit: # bad arguments, the job fails with a status when it runs
+		return job
+
+def read_status(status_dir, job):
+	try:
+		with open(status_dir/f"{job_id(job)}.json") as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return None
+
+def write_status(status_dir, job, **status):
+	# one file per job, replaced atomically, so workers never write the same file and a crash loses nothing
+	path = status_dir/f"{job_id(job)}.json"
+	with open(f"{path}.tmp", "w") as f:
+		json.dump(dict(job=job, **status), f, indent=2)
+	os.replace(f"{path}.tmp", path)
+	return dict(job=job, **status)
+
+def folder_size(folder):
+	return sum(x.stat().st_size for x in Path(folder).iterdir() if x.is_file())
+
+loaded_models = {} # model_key => load_model result, only the last model is kept
+
+def run_job(job, status_dir):
+	write_status(status_dir, job, status="running", pid=os.getpid())
+	start = time.perf_counter()
+	cached = False
+	try:
+		with open(status_dir/f"{job_id(job)}.log", "w", encoding="utf-8") as log, contextlib.redirect_stdout(log), torch.no_grad():
+			try:
+				with contextlib.redirect_stderr(log):
+					args = convert.parse_args(shlex.split(job))
+			except SystemExit:
+				raise ValueError("invalid arguments, see log") from None
+			inputs = convert.convert_inputs(args)
+			key = model_key(args)
+			cached = key in loaded_models
+			if not args.force and inputs is not None and convert.up_to_date(convert.output_folder(args), inputs):
+				folder = convert.convert_model(args) # skipped before loading the model
+			else:
+				if not cached:
+					loaded_models.clear()
+					loaded_models[key] = convert.load_model(args)
+				if loaded_models[key] is None:
+					raise ValueError(f"{args.model} is not a supported model")
+				folder = convert.convert_model(args, loaded_models[key])
+	except Exception as e:
+		with open(status_dir/f"{job_id(job)}.log", "a", encoding="utf-8") as log:
+			traceback.print_exc(file=log)
+		return write_status(status_dir, job, status="failed", time=time.perf_counter()-start, cached=cached,
+			error=f"{type(e).__name__}: {e}")
+	return write_status(status_dir, job, status="done", time=time.perf_counter()-start, cached=cached,
+		folder=str(folder), bytes=folder_size(folder))
+
+def run_group(jobs, status_dir):
+	return [run_job(job, status_dir) for job in jobs]
+
+def init_worker():
+	convert.disable_exllama()
+
+def print_summary(results):
+	print(f"{'status':>8} {'time':>8} {'size':>10}  job")
+	for x in results:
+		size = f"{x['bytes']/2**20:8.1f}MiB" if "bytes" in x else ""
+		elapsed = f"{x['time']:7.1f}s" if "time" in x else ""
+		print(f"{x['status']:>8} {elapsed:>8} {size:>10}  {x['job']}{' (cached model)' if x.get('cached') else ''}")
+		if x["status"] == "failed":
+			print(f"{'':>30}{x['error']}")
+	done = [x for x in results if x["status"] in ("done", "skipped")]
+	print(f"{len(done)}/{len(results)} done, {sum(x.get('time', 0) for x in results if x['status'] != 'skipped'):.1f}s,"
+		f" {sum(x.get('bytes', 0) for x in done)/2**20:.1f}MiB")
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('jobs', help='job file with one convert.py command line per line')
+	parser.add_argument('--workers', type=int, default=1, help='number of processes, each converting different models')
+	parser.add_argument('--status', type=str, help='folder of job status and logs. default: JOBS.status')
+	parser.add_argument('--rerun', action='store_true', help='run jobs that are already done')
+	args = parser.parse_args()
+
+	jobs = read_jobs(args.jobs)
+	status_dir = Path(args.status or f"{args.jobs}.status")
+	os.makedirs(status_dir, exist_ok=True)
+
+	# resume: jobs that were done are skipped, and jobs left running by a crash run again
+	results = {}
+	groups = {}
+	for job in jobs:
+		status = read_status(status_dir, job)
+		if status is not None and status["status"] == "done" and not args.rerun:
+			results[job] = dict(status, status="skipped")
+			continue
+		groups.setdefault(group_key(job), []).append(job)
+	print(f"batch: {len(jobs)} jobs, {len(jobs)-len(results)} to run in {len(groups)} model groups")
+
+	if args.workers <= 1:
+		init_worker()
+		for group in groups.values():
+			for job in group:
+				print(f"\t{job}")
+				results[job] = run_job(job, status_dir)
+				print(f"\t\t{results[job]['status']}")
+	else:
+		with ProcessPoolExecutor(args.workers, initializer=init_worker) as pool:
+			futures = [pool.submit(run_group, group, status_dir) for group in groups.values()]
+			for future in as_completed(futures):
+				for x in future.result():
+					print(f"\t{x['job']}\n\t\t{x['status']}")
+					results[x["job"]] = x
+
+	print_summary([results[job] for job in jobs])
+	sys.exit(any(x["status"] == "failed" for x in results.values()))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,283 @@
+import time
+import argparse
+import multiprocessing
+
+def measure(fn, *args):
+	# run in a fresh process so that peak rss is not polluted by earlier runs
+	with multiprocessing.get_context("spawn").Pool(1) as pool:
+		return pool.apply(fn, args)
+
+def run_int8(rows, cols, max_memory):
+	import torch
+	import convert
+	torch.manual_seed(0)
+	data = torch.randn(rows, cols)
+	rss = convert.peak_rss()
+	start = time.perf_counter()
+	convert.export_custom_int8(data, max_memory=max_memory)
+	return time.perf_counter()-start, convert.peak_rss()-rss
+
+def bench_int8(args):
+	print(f"{'size':>12} {'max_memory':>12} {'time':>8} {'peak rss':>10}")
+	for size in args.sizes:
+		rows, cols = map(int, size.split("x"))
+		for max_memory in [None, int(args.max_memory*1024*1024)]:
+			elapsed, rss = measure(run_int8, rows, cols, max_memory)
+			budget = f"{max_memory>>20}MiB" if max_memory else "unbounded"
+			print(f"{size:>12} {budget:>12} {elapsed:7.2f}s {rss/2**20:7.0f}MiB")
+
+def load_json_tokenizer(path):
+	# python proxy of a loader that parses tokenizer.json and splits merges into pairs at startup
+	import json
+	with open(path, encoding="utf-8") as f:
+		data = json.load(f)
+	vocab = {x: i for i, x in enumerate(data["vocab"])}
+	ranks = {}
+	for rank, merge in enumerate(data["merges"] or []):
+		# tokens may contain spaces, so find the split whose halves and concatenation are tokens
+		for i, c in enumerate(merge):
+			if c == " " and merge[:i] in vocab and merge[i+1:] in vocab and merge[:i]+merge[i+1:] in vocab:
+				ranks.setdefault((merge[:i], merge[i+1:]), rank)
+				break
+	return vocab, ranks
+
+def encode_json_tokenizer(vocab, ranks, word, byte_level):
+	# same algorithm as tokenizer.Tokenizer.encode_word on latin-1 strings of bytes
+	if byte_level:
+		symbols = list(word.decode("latin-1"))
+	else:
+		symbols = []
+		for c in word.decode("utf-8", errors="surrogateescape"):
+			c = c.encode("utf-8", errors="surrogateescape").decode("latin-1")
+			symbols.extend([c] if c in vocab else c)
+	while len(symbols) > 1:
+		pairs = [(ranks[x], x) for x in zip(symbols, symbols[1:]) if x in ranks]
+		if not pairs:
+			break
+		_, (left, right) = min(pairs)
+		out = []
+		i = 0
+		while i < len(symbols):
+			if i+1 < len(symbols) and symbols[i] == left and symbols[i+1] == right:
+				out.append(left+right)
+				i += 2
+			else:
+				out.append(symbols[i])
+				i += 1
+		symbols = out
+	return [vocab[x] for x in symbols]
+
+def bench_tokenizer(args):
+	import re
+	import tokenizer
+	from pathlib import Path
+	folder = Path(args.folder)
+	text = Path(args.text).read_text(encoding="utf-8") if args.text else (
+		"In a shocking finding, scientists discovered a herd of unicorns living in a remote, "
+		"previously unexplored valley, in the Andes Mountains. Even more surprising to the "
+		"researchers was the fact that the unicorns spoke perfect English. ") * 20
+	words = [x.encode() for x in re.findall(r" ?[^ ]+", text)]
+
+	start = time.perf_counter()
+	vocab, ranks = load_json_tokenizer(folder/"tokenizer.json")
+	json_load = time.perf_counter()-start
+	start = time.perf_counter()
+	tok = tokenizer.Tokenizer.from_file(folder/"tokenizer.bytes")
+	bytes_load = time.perf_counter()-start
+
+	start = time.perf_counter()
+	json_ids = [x for word in words for x in encode_json_tokenizer(vocab, ranks, word, tok.byte_level)]
+	json_encode = time.perf_counter()-start
+	start = time.perf_counter()
+	bytes_ids = tok.encode(words)
+	bytes_encode = time.perf_counter()-start
+
+	size = sum(len(x) for x in words)
+	# both loaders and encoders are python proxies, not the runtime importer
+	print("python proxies of loading and encoding")
+	print(f"{'format':>16} {'startup':>10} {'encode':>14}")
+	print(f"{'tokenizer.json':>16} {json_load*1000:8.1f}ms {size/json_encode/1024:10.1f}KiB/s")
+	print(f"{'tokenizer.bytes':>16} {bytes_load*1000:8.1f}ms {size/bytes_encode/1024:10.1f}KiB/s")
+	print(f"{len(bytes_ids)} tokens, " + ("same ids" if json_ids == bytes_ids else "different ids"))
+
+def bench_codec(args):
+	import cv2
+	import numpy as np
+	import texture
+	from pathlib import Path
+	files = sorted(x for x in Path(args.folder).iterdir() if x.suffix in (".exr", ".png"))
+	sizes, times, picks = {}, {}, {}
+	for path in files:
+		buf = np.fromfile(path, dtype=np.uint8)
+		start = time.perf_counter()
+		data = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+		elapsed = time.perf_counter()-start
+		results = texture.encode_codecs(data, path.suffix, repeat=args.repeat)
+		results["current"] = (buf, elapsed)
+		for codec, (buf, elapsed) in results.items():
+			sizes[codec] = sizes.get(codec, 0) + len(buf)
+			times[codec] = times.get(codec, 0) + elapsed
+		del results["current"]
+		for policy in texture.CODEC_POLICIES:
+			codec = texture.pick_codec(results, policy)
+			sizes[policy] = sizes.get(policy, 0) + len(results[codec][0])
+			times[policy] = times.get(policy, 0) + results[codec][1]
+
+	print(f"{len(files)} files")
+	print(f"{'codec':>12} {'size':>10} {'decode':>8}")
+	for codec in sizes:
+		print(f"{codec:>12} {sizes[codec]/2**20:8.2f}MiB {times[codec]:7.3f}s")
+
+def run_export(model, folder, device, quantize, threads, atlas=None):
+	import io
+	import contextlib
+	import numpy as np
+	import torch
+	import convert
+	from pathlib import Path
+	from transformers import AutoModelForCausalLM
+	model = AutoModelForCausalLM.from_pretrained(model, device_map=device)
+	start = time.perf_counter()
+	with torch.no_grad(), contextlib.redirect_stdout(io.StringIO()):
+		convert.export_lm(model, Path(folder), force_write=True, threads=threads, atlas=atlas,
+			quantize=(lambda name, shape: np.prod(shape) >= quantize*1024*1024) if quantize else None)
+	return time.perf_counter()-start, sum(x.stat().st_size for x in Path(folder).iterdir())
+
+def bench_pipeline(args):
+	import tempfile
+	print(f"{'threads':>8} {'time':>8} {'output':>14} {'speedup':>8}")
+	base = None # time of the first row
+	for threads in args.threads:
+		with tempfile.TemporaryDirectory() as folder:
+			elapsed, size = measure(run_export, args.model, folder, args.device, args.quantize, threads)
+		base = base or elapsed
+		print(f"{threads or 'serial':>8} {elapsed:7.2f}s {size/elapsed/2**20:9.1f}MiB/s {base/elapsed:7.2f}x")
+
+def bench_atlas(args):
+	# unity imports every texture as an asset, so the decode time of each file stands in for its import time
+	import tempfile
+	import runtime
+	from pathlib import Path
+	print(f"{'atlas':>8} {'files':>6} {'textures':>9} {'size':>10} {'memory':>10} {'decode':>8}")
+	for atlas in [None, "model", "layer"]:
+		with tempfile.TemporaryDirectory() as folder:
+			measure(run_export, args.model, folder, args.device, args.quantize, 0, atlas)
+			files = list(Path(folder).iterdir())
+			textures = [x for x in files if x.suffix in (".exr", ".png")]
+			memory, elapsed = 0, 0
+			for path in textures:
+				times = []
+				for _ in range(args.repeat):
+					start = time.perf_counter()
+					data = runtime.imread(path)
+					times.append(time.perf_counter()-start)
+				memory += data.nbytes
+				elapsed += min(times)
+			size = sum(x.stat().st_size for x in files)
+		print(f"{atlas or 'none':>8} {len(files):>6} {len(textures):>9} {size/2**20:8.2f}MiB {memory/2**20:8.2f}MiB {elapsed:7.3f}s")
+
+def gptq_group(state_dict, name, size0):
+	# (bits, group_size) of a GPTQ tensor, from its textures
+	import runtime
+	path = state_dict.folder/state_dict.aliases.get(name, name)
+	weight = runtime.untile(runtime.imread(f"{path}.png"), size0)
+	scales = runtime.untile(runtime.imread(f"{path}.q8.exr"), (size0+3)//4)
+	return 4 if (weight % 17 == 0).all() else 8, weight.shape[1]*4 // scales.shape[1]
+
+def bench_quantize(args):
+	import json
+	import numpy as np
+	import torch
+	import convert
+	import runtime
+	from pathlib import Path
+	with open(Path(args.folder)/"testcase.json") as f:
+		input_ids = np.array([json.load(f)["input_ids"]])
+
+	def evaluate(model):
+		logits, _ = model(input_ids)
+		model.CacheClear()
+		tokens = model.generate(input_ids, args.max_new_tokens)[0]
+		model.CacheClear()
+		return logits[0], tokens
+
+	# the exported tensors are the reference, and every quantizable one is quantized like --quantize 0
+	model = runtime.from_pretrained(args.folder)
+	ref_logits, ref_tokens = evaluate(model)
+	params = dict(model.params)
+	names = [name for name, x in params.items() if convert.can_quantize(name, x.shape)]
+	rows = []
+	for bits, group_size in [(None, None), (8, 4)] + [(4, x) for x in args.group_sizes]:
+		model.params = dict(params)
+		size = 0
+		for name, x in params.items():
+			if bits and name in names:
+				arrays = convert.export_quantized(torch.from_numpy(x), bits=bits, group_size=group_size)
+				model.params[name] = convert.dequantize_quantized(arrays, x.shape, bits).numpy()
+			if name not in model.state_dict.aliases: # aliases share textures
+				size += convert.texture_bytes(x.shape, f"int{bits}" if bits and name in names else "float32", group_size)
+		rows.append((f"int{bits}/{group_size}" if bits else "float32", size, *evaluate(model)))
+
+	# GPTQ exports of the same model, run as they are
+	for folder in args.gptq:
+		model = runtime.from_pretrained(folder)
+		model(input_ids[:, :1])
+		model.CacheClear()
+		size = 0
+		for name, x in model.params.items():
+			if name in model.state_dict.aliases:
+				continue
+			if Path(f"{model.state_dict.folder/model.state_dict.aliases.get(name, name)}.q8.exr").exists():
+				bits, group_size = gptq_group(model.state_dict, name, x.shape[0])
+				size += convert.texture_bytes(x.shape, f"int{bits}", group_size)
+			else:
+				size += convert.texture_bytes(x.shape, "float32")
+		rows.append((f"gptq {Path(folder).name}", size, *evaluate(model)))
+
+	print(f"{len(names)} quantizable tensors, {input_ids.shape[1]} prompt tokens, {args.max_new_tokens} greedy tokens")
+	print(f"{'format':>12} {'size':>10} {'logits err':>10} {'top1':>6} {'greedy':>6}")
+	for format, size, logits, tokens in rows:
+		error = np.sqrt(np.mean((logits-ref_logits)**2) / np.mean(ref_logits**2))
+		top1 = np.mean(logits.argmax(-1) == ref_logits.argmax(-1))
+		greedy = np.cumprod(tokens == ref_tokens).sum() # tokens until the first difference
+		print(f"{format:>12} {size/2**20:8.2f}MiB {error:10.4f} {top1:6.1%} {greedy:>6}")
+
+def main():
+	parser = argparse.ArgumentParser()
+	subparsers = parser.add_subparsers(required=True)
+	parser_int8 = subparsers.add_parser("int8", help="peak memory and time of export_custom_int8")
+	parser_int8.add_argument("--sizes", nargs="+", default=["2048x2048", "8192x2048", "32000x2048"])
+	parser_int8.add_argument("--max-memory", type=float, default=256, help="memory budget in MiB")
+	parser_int8.set_defaults(func=bench_int8)
+	parser_tokenizer = subparsers.add_parser("tokenizer", help="startup and encode throughput of tokenizer.bytes and tokenizer.json, measured on python proxies")
+	parser_tokenizer.add_argument("folder", help="exported model folder")
+	parser_tokenizer.add_argument("--text", type=str, help="utf-8 text file to encode")
+	parser_tokenizer.set_defaults(func=bench_tokenizer)
+	parser_codec = subparsers.add_parser("codec", help="encoded size and decode time of lossless codecs on an exported folder")
+	parser_codec.add_argument("folder", help="exported model folder")
+	parser_codec.add_argument("--repeat", type=int, default=3, help="number of decodes to take the fastest of")
+	parser_codec.set_defaults(func=bench_codec)
+	parser_quantize = subparsers.add_parser("quantize", help="logit error and texture size of int8, int4 and GPTQ against an exported folder")
+	parser_quantize.add_argument("folder", nargs="?", default="../Model/TinyStories-1M", help="exported float model folder with testcase.json")
+	parser_quantize.add_argument("--group-sizes", type=int, nargs="+", default=[16, 32, 64], help="group sizes of int4")
+	parser_quantize.add_argument("--gptq", nargs="*", default=[], help="folders exported from GPTQ versions of the same model")
+	parser_quantize.add_argument("--max-new-tokens", type=int, default=32)
+	parser_quantize.set_defaults(func=bench_quantize)
+	parser_pipeline = subparsers.add_parser("pipeline", help="export time of the pipelined export_lm against the serial one")
+	parser_pipeline.add_argument("model", help="model id or path")
+	parser_pipeline.add_argument("--device", type=str)
+	parser_pipeline.add_argument("--quantize", type=float)
+	parser_pipeline.add_argument("--threads", type=int, nargs="+", default=[0, 1, 2, 4], help="encoder threads, 0 for serial")
+	parser_pipeline.set_defaults(func=bench_pipeline)
+	parser_atlas = subparsers.add_parser("atlas", help="file count, size and decode time of textures with and without --atlas")
+	parser_atlas.add_argument("model", help="model id or path")
+	parser_atlas.add_argument("--device", type=str)
+	parser_atlas.add_argument("--quantize", type=float)
+	parser_atlas.add_argument("--repeat", type=int, default=3, help="number of decodes to take the fastest of")
+	parser_atlas.set_defaults(func=bench_atlas)
+
+	args = parser.parse_args()
+	args.func(args)
+
+if __name__ == '__main__':
+	main()
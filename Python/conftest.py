@@ -0,0 +1,25 @@
+import pytest
+
+# fixtures shared by the test modules. models and tokenizers are tiny ones made here, so nothing is downloaded
+
+@pytest.fixture(scope="session")
+def gpt2_folder(tmp_path_factory):
+	# a tiny random gpt2 saved like a checkpoint, with a byte-level tokenizer of single bytes
+	torch = pytest.importorskip("torch")
+	transformers = pytest.importorskip("transformers")
+	tokenizers = pytest.importorskip("tokenizers")
+	from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+	torch.manual_seed(0)
+	config = transformers.GPT2Config(vocab_size=256, n_positions=32, n_embd=64, n_layer=2, n_head=2)
+	folder = tmp_path_factory.mktemp("gpt2")
+	transformers.GPT2LMHeadModel(config).save_pretrained(folder)
+	tok = tokenizers.Tokenizer(tokenizers.models.BPE({c: b for b, c in bytes_to_unicode().items()}, []))
+	tok.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+	tok.decoder = tokenizers.decoders.ByteLevel()
+	transformers.PreTrainedTokenizerFast(tokenizer_object=tok).save_pretrained(folder)
+	return folder
+
+@pytest.fixture
+def textures():
+	# texture files of an exported folder by name
+	return lambda folder: {x.name: x.read_bytes() for x in sorted(folder.iterdir()) if x.suffix in (".exr", ".png")}
@@ -1,88 +1,212 @@
 import os
 os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
 
+import sys
 import math
 import re
+import time
 import json
+import mmap
+import hashlib
+import threading
+import contextlib
 import torch
 import torch.nn.functional as F
 import numpy as np
-import cv2
 from pathlib import Path
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from tokenizer import pack_tokenizer
+from quant import export_custom_int8, export_quantized, custom_int8_error
+from texture import CODEC_POLICIES, ATLAS_MODES, imwrite, select_codec, pad_align, pad_tile, can_quantize, atlas_name, pack_atlas
 
-def imwrite(path, data):
-	data = data[..., [2,1,0,3]] # RGBA to BGRA
-	if data.dtype == np.float16 or data.dtype == np.float32:
-		cv2.imwrite(str(path), data.astype(np.float32), (
-			cv2.IMWRITE_EXR_TYPE,
-			cv2.IMWRITE_EXR_TYPE_HALF if data.dtype == np.float16 else cv2.IMWRITE_EXR_TYPE_FLOAT,
-			cv2.IMWRITE_EXR_COMPRESSION,
-			cv2.IMWRITE_EXR_COMPRESSION_PIZ)) # https://aras-p.info/blog/2021/08/04/EXR-Lossless-Compression/
-	elif data.dtype == np.ubyte:
-		cv2.imwrite(str(path), data)
+CONVERTER_VERSION = 1 # bump when the output of the same tensor changes
+
+def peak_rss():
+	try:
+		import resource
+	except ImportError: # windows
+		return 0
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss if sys.platform == "darwin" else rss*1024
+
+class Profiler:
+	def __init__(self):
+		self.events = []
+		self.local = threading.local()
+		self.formats = {} # tensor name => format, or None if skipped
+
+	@property
+	def tensor(self):
+		# the tensor of the current thread, which differs between pipeline stages
+		return getattr(self.local, "tensor", None)
+	@tensor.setter
+	def tensor(self, value):
+		self.local.tensor = value
+
+	@contextlib.contextmanager
+	def span(self, name, **args):
+		# args can be updated inside the span, e.g. with bytes_out
+		if self.tensor is not None:
+			args.setdefault("tensor", self.tensor)
+		rss = peak_rss()
+		start = time.perf_counter()
+		try:
+			yield args
+		finally:
+			self.events.append(dict(name=name, pid=os.getpid(), tid=threading.get_native_id(), start=start,
+				time=time.perf_counter()-start, rss=peak_rss()-rss, **args))
+
+	def report(self):
+		stages = {}
+		tensors = {}
+		for e in self.events:
+			x = stages.setdefault(e["name"], dict(count=0, time=0, rss=0, bytes_in=0, bytes_out=0))
+			x["count"] += 1
+			x["time"] += e["time"]
+			x["rss"] = max(x["rss"], e["rss"])
+			x["bytes_in"] += e.get("bytes_in", 0)
+			x["bytes_out"] += e.get("bytes_out", 0)
+			if e.get("tensor") is not None:
+				x = tensors.setdefault(e["tensor"], dict(time=0, rss=0, bytes_out=0, stages={}))
+				x["time"] += e["time"]
+				x["rss"] = max(x["rss"], e["rss"])
+				x["bytes_out"] += e.get("bytes_out", 0) if e["name"] == "encode" else 0
+				x["stages"][e["name"]] = x["stages"].get(e["name"], 0) + e["time"]
+		for name, fmt in self.formats.items():
+			x = tensors.setdefault(name, dict(time=0, rss=0, bytes_out=0, stages={}))
+			x["format"] = fmt
+			x["skipped"] = fmt is None
+		return dict(stages=stages, tensors=tensors)
+
+	def trace(self):
+		# chrome://tracing or https://ui.perfetto.dev
+		origin = min((e["start"] for e in self.events), default=0)
+		return dict(traceEvents=[dict(name=e["name"], cat="convert", ph="X", pid=e["pid"], tid=e["tid"],
+			ts=(e["start"]-origin)*1e6, dur=e["time"]*1e6,
+			args={k: v for k, v in e.items() if k not in ("name", "pid", "tid", "start", "time")}) for e in self.events])
+
+profiler = None # set to a Profiler to record conversion stages
+
+def span(name, **args):
+	return profiler.span(name, **args) if profiler is not None else contextlib.nullcontext(args)
+
+def profile_call(tensor, fn, *args):
+	# run in a worker process with its own profiler, and return the events along with the result
+	global profiler
+	profiler = Profiler()
+	profiler.tensor = tensor
+	try:
+		return fn(*args), profiler.events
+	finally:
+		profiler = None
+
+def in_thread(tensor, fn, *args):
+	# run in a pipeline thread, attributing profiler spans to the tensor
+	if profiler is not None:
+		profiler.tensor = tensor
+	return fn(*args)
+
+def hash_tensors(*tensors):
+	h = hashlib.sha256()
+	for x in tensors:
+		h.update(f"{x.dtype}{tuple(x.shape)}".encode())
+		h.update(x.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy())
+	return h.hexdigest()
+
+def dequantize_quantized(arrays, shape, bits=8):
+	import runtime # same math as the shader
+	weight, quant, indices = arrays
+	if bits == 4:
+		data = runtime.dequantize_gptq(weight, quant)
 	else:
-		raise NotImplementedError
+		data = runtime.dequantize_custom_int8(weight.astype(np.float32), quant)
+	if indices is not None:
+		data = data[:, indices[1].astype(np.int64)]
+	return torch.from_numpy(np.ascontiguousarray(data[:, :shape[1]]))
 
-def pad_align(data, align):
-	return np.pad(data, [(0,(-n)%m) for n, m in zip(data.shape, align)])
+PLAN_GROUP_SIZES = (4, 8, 16, 32, 64) # multiples of 4, so that S in Linear.shader and Gather.shader is an integer
 
-def export_custom_int8(data, asym=True, group_size=4, *, estep=2, exact=False, act_order=True):
-	data = F.pad(data, (0,-data.shape[-1] % group_size)) # must pad before sorting
-	indices = None
-	if act_order:
-		indices = torch.argsort(torch.linalg.norm(data, ord=1, dim=0), stable=True, descending=True)
-		data = data[:,indices]
-		indices = torch.stack((indices, torch.argsort(indices))).float().cpu().numpy() # use float for int indices
-	data = data.reshape(data.shape[0], -1, group_size)
-
-	presets = [(-127/256, +127/256, 0)] + ([(-63/256, +191/256, +85), (-191/256, +63/256, -85)] if asym else [])
-	bmin, bmax, eoff = torch.tensor(presets, dtype=data.dtype, device=data.device).T[..., None, None, None]
-	expo = torch.clip(torch.ceil(estep*torch.log2(torch.maximum(
-		torch.clip(torch.amin(data, dim=-1, keepdims=True), max=0)/bmin,
-		torch.clip(torch.amax(data, dim=-1, keepdims=True), min=0)/bmax))), -42, 42)
-
-	scale = torch.exp2((expo/estep).to(torch.float32 if exact else data.dtype))
-	mant = torch.clip(data/scale, bmin, bmax)
-	qerr = torch.amax(torch.abs(torch.round(mant*256)/256 * scale - data), dim=-1, keepdims=True)
-	best = torch.argmin(qerr, dim=0, keepdims=True)
-	expo = torch.take_along_dim(expo+eoff, best, dim=0)[0]
-	mant = torch.take_along_dim(mant, best, dim=0)[0]
-	mant /= 255/256
-	mant += torch.where(mant < -1/510, 1, 0)
-
-	mant = mant.reshape(mant.shape[0], -1).cpu().numpy()
-	expo = F.pad(expo, (0,0,0,0,0,-expo.shape[-3] % 4)).reshape(-1, 4, expo.shape[1]).permute(0,2,1)
-	expo = expo.reshape(expo.shape[0], -1).cpu().numpy()
-	return mant, expo.astype(np.int8).astype(np.uint8), indices
+def texture_bytes(shape, format, group_size=4):
+	# texture memory after import, with UseUnorm8 for int8 weights, or UseUnorm4 for int4 weights
+	size0 = math.prod(shape[:-1])
+	if format not in ("int8", "int4"):
+		return size0 * (-(-shape[-1]//4)*4) * (2 if format == "float16" else 4)
+	size1 = -(-shape[-1]//group_size)*group_size
+	if format == "int4": # 4-bit weights and float scales
+		return size0*size1//2 + (size0+3)//4*4 * (size1//group_size)*4 + 2*size1*4
+	return size0*size1 + (size0+3)//4*4 * (size1//group_size) + 2*size1*4 # weight, scales and float indices
+
+def plan_candidates(data, int8_args=None, drift=None):
+	# {format: (texture bytes, error)}. the error is the rms of qerr relative to the rms of the tensor,
+	# or the logit drift if drift(tensor) is given
+	norm = torch.sqrt(torch.mean(data.double()**2)).item() or 1
+	half = data.half()
+	qerr = torch.abs(half.double() - data.double())
+	qerr = F.pad(qerr, (0, -qerr.shape[-1] % 4)).reshape(-1, 4).amax(dim=-1) # groups of 4 like int8
+	candidates = {
+		"float32": (texture_bytes(data.shape, "float32"), 0.0),
+		"float16": (texture_bytes(data.shape, "float16"), drift(half) if drift else torch.sqrt(torch.mean(qerr**2)).item()/norm),
+	}
+	for group_size in PLAN_GROUP_SIZES if int8_args is not None else []:
+		if drift:
+			error = drift(dequantize_quantized(export_custom_int8(data, group_size=group_size, **int8_args), data.shape))
+		else:
+			error = custom_int8_error(data, group_size=group_size, **int8_args)/norm
+		candidates[f"int8/{group_size}"] = (texture_bytes(data.shape, "int8", group_size), error)
+	return candidates
+
+def solve_plan(candidates, budget):
+	# multiple-choice knapsack solved greedily: start from the most accurate format of each tensor, then take the change
+	# that saves most bytes per added error while the total error is within budget
+	choice = {name: min(c, key=lambda k: (c[k][1], c[k][0])) for name, c in candidates.items()}
+	error = sum(candidates[name][k][1] for name, k in choice.items())
+	while True:
+		best = None
+		for name, c in candidates.items():
+			size0, error0 = c[choice[name]]
+			for k, (size, err) in c.items():
+				if size < size0 and error + err - error0 <= budget:
+					gain = (size0 - size) / max(err - error0, 1e-12)
+					if best is None or gain > best[0]:
+						best = (gain, name, k)
+		if best is None:
+			return choice
+		_, name, k = best
+		error += candidates[name][k][1] - candidates[name][choice[name]][1]
+		choice[name] = k
 
 def disable_exllama():
 	from transformers import GPTQConfig
 	post_init = GPTQConfig.post_init
 	GPTQConfig.post_init = lambda self: setattr(self, "use_exllama", False) or post_init(self)
 
-def unpack_gptq(layer):
-	bias = layer.bias
-	layer.bias = None
-	weight = layer(torch.eye(layer.infeatures, dtype=layer.scales.dtype, device=layer.scales.device)).transpose(1,0)
-	layer.bias = bias
-	return weight
-
-def export_gptq(layer):
-	assert layer.group_size % 4 == 0, f"group_size {layer.group_size} should be a multiple of 4"
-	assert 8 % layer.bits == 0, f"bits {layer.bits} should be a divisor of 8"
-	assert str(type(layer)).find("exllama") < 0, "exllama backend is not supported"
+def unpack_gptq_bits(layer):
 	wf = torch.tensor(list(range(0, 32, layer.bits)), dtype=torch.int32).unsqueeze(0).to(layer.qweight.device)
-
-	scales = layer.scales
 	zeros = torch.bitwise_right_shift(
 		torch.unsqueeze(layer.qzeros, 2).expand(-1, -1, 32//layer.bits),
 		wf.unsqueeze(0)
-	).to(torch.uint8).add(1).bitwise_and(2**layer.bits - 1).reshape(scales.shape) # not sure on wrapping add 1
+	).to(torch.uint8).add(1).bitwise_and(2**layer.bits - 1).reshape(layer.scales.shape) # not sure on wrapping add 1
 	weight = torch.bitwise_right_shift(
 		torch.unsqueeze(layer.qweight, 1).expand(-1, 32//layer.bits, -1),
 		wf.unsqueeze(-1)
 	).to(torch.uint8).bitwise_and(2**layer.bits - 1)
 	weight = weight.reshape(weight.shape[0] * weight.shape[1], weight.shape[2])
+	return weight, zeros
+
+def unpack_gptq(layer):
+	assert 8 % layer.bits == 0, f"bits {layer.bits} should be a divisor of 8"
+	weight, zeros = unpack_gptq_bits(layer)
+	g_idx = layer.g_idx.long()
+	weight = layer.scales[g_idx] * (weight[:layer.infeatures].to(torch.int16) - zeros[g_idx].to(torch.int16))
+	return weight.transpose(1,0)
+
+def export_gptq(layer):
+	assert layer.group_size % 4 == 0, f"group_size {layer.group_size} should be a multiple of 4"
+	assert 8 % layer.bits == 0, f"bits {layer.bits} should be a divisor of 8"
+	assert str(type(layer)).find("exllama") < 0, "exllama backend is not supported"
+	weight, zeros = unpack_gptq_bits(layer)
+	scales = layer.scales
 
 	default_g_idx = torch.arange(layer.g_idx.shape[0], device=layer.g_idx.device) // layer.group_size
 	if torch.all(layer.g_idx == default_g_idx):
@@ -107,38 +231,229 @@ def export_gptq(layer):
 	scales = scales.reshape(scales.shape[0], -1)
 	return weight, scales, indices
 
-def export_lm(model, folder, force_write=False, quantize=None, max_positions=16384):
+def encode_texture(path, array, codec=None):
+	# returns the codec report entry, or None without codec
+	report = None
+	with span("encode", file=path.name, bytes_in=array.nbytes) as info:
+		if codec is not None:
+			report = select_codec(path, array, codec)
+			info["codec"] = report["codec"]
+		else:
+			imwrite(path, array)
+		info["bytes_out"] = os.path.getsize(path)
+	return report
+
+def export_tensor(folder, filenames, data, quant_args=None, arrays=None, codec=None, encode=encode_texture):
+	# encode may return futures instead of encode_texture results, for the caller to wait for
+	report = []
+	if arrays is None and quant_args is not None:
+		with span("quantize", format=f"int{quant_args.get('bits', 8)}", bytes_in=data.nbytes) as info:
+			arrays = export_quantized(data, **quant_args)
+			info["bytes_out"] = sum(x.nbytes for x in arrays if x is not None)
+	elif arrays is None:
+		arrays = (data.cpu().numpy(),)
+	for filename, array in zip(filenames, arrays):
+		if array is None:
+			continue
+		print(f"\t\t{filename}\t{tuple(array.shape)}")
+		with span("pad_tile", file=filename, bytes_in=array.nbytes) as info:
+			array = pad_tile(array)
+			info["bytes_out"] = array.nbytes
+		report.append(encode(folder/filename, array, codec))
+	return [x for x in report if x is not None]
+
+def copy_to_host(data):
+	# returns (host tensor, cuda event to wait for). cuda tensors are copied to pinned memory without blocking
+	if data.device.type != "cuda":
+		return data.cpu(), None
+	host = torch.empty(data.shape, dtype=data.dtype, pin_memory=True)
+	host.copy_(data, non_blocking=True)
+	event = torch.cuda.Event()
+	event.record()
+	return host, event
+
+def pipeline_tensor(event, encoder, tensor, *args):
+	# second stage of the pipeline: quantize and pad, and hand textures to encoder threads
+	if event is not None:
+		with span("to_host_wait"):
+			event.synchronize()
+	return export_tensor(*args, encode=lambda *x: encoder.submit(in_thread, tensor, encode_texture, *x))
+
+def init_worker():
+	torch.set_num_threads(1) # parallelism comes from the process pool
+
+def pad_head_dim(data, head_dim, half_dim, o_proj):
+	view = data.view(data.shape[0], -1, head_dim, 1) if o_proj\
+		else data.view(1, -1, head_dim, data.numel() // data.shape[0])
+	view = torch.cat((
+		torch.nn.functional.pad(view[:, :, 0*half_dim:1*half_dim], (0,0, 0,-half_dim%2)),
+		torch.nn.functional.pad(view[:, :, 1*half_dim:2*half_dim], (0,0, 0,-half_dim%2)),
+		torch.nn.functional.pad(view[:, :, 2*half_dim:], (0,0, 0,-(head_dim-2*half_dim)%4)),
+	), dim=2)
+	return view.view(data.shape[0], -1) if o_proj else view.view(-1, *data.shape[1:])
+
+def bake_relative_attention_bias(weight, layer, max_positions=None):
+	# relative positions in [-n, n), where n is also the center used by T5.cs
+	n = min(layer.relative_attention_max_distance, max_positions or layer.relative_attention_max_distance)
+	relative_position_bucket = layer._relative_position_bucket(
+		torch.arange(-n, n, dtype=torch.long, device=weight.device),
+		bidirectional=(not layer.is_decoder),
+		num_buckets=layer.relative_attention_num_buckets,
+		max_distance=layer.relative_attention_max_distance,
+	)
+	return F.embedding(relative_position_bucket, weight).permute(1, 0)[None,:,:]
+
+def rotary_weight(model, layer, max_positions):
+	if hasattr(layer, "cos_cached"): # deprecated in torch 4.39
+		cos_cached, sin_cached = layer.cos_cached, layer.sin_cached
+	elif hasattr(layer, "_cached_cos"): # TODO: OpenELMRotaryEmbedding
+		cos_cached, sin_cached = layer._cached_cos[0,0], layer._cached_sin[0,0]
+	else:
+		pos_id = torch.arange(min(model.config.max_position_embeddings, max_positions),
+			dtype=torch.float32, device=layer.inv_freq.device).unsqueeze(0)
+		cos_cached, sin_cached = (x[0] for x in layer(pos_id, pos_id))
+	half_dim = cos_cached.shape[-1]//2
+	return torch.cat(( # pad rotary weights as complex numbers
+		torch.nn.functional.pad(cos_cached[:max_positions, :half_dim], (0, -half_dim%2), value=1),
+		torch.nn.functional.pad(sin_cached[:max_positions, :half_dim], (0, -half_dim%2), value=0)), dim=-1)
+
+@contextlib.contextmanager
+def init_empty_weights():
+	# put parameters on meta device but keep buffers (e.g. inv_freq) on cpu
+	register_parameter = torch.nn.Module.register_parameter
+	def register_empty_parameter(module, name, param):
+		register_parameter(module, name, param)
+		if param is not None and not param.is_meta:
+			module._parameters[name] = torch.nn.Parameter(param.to("meta"), requires_grad=param.requires_grad)
+	torch.nn.Module.register_parameter = register_empty_parameter
+	try:
+		yield
+	finally:
+		torch.nn.Module.register_parameter = register_parameter
+
+class SafetensorsFile:
+	dtypes = dict(F64=torch.float64, F32=torch.float32, F16=torch.float16, BF16=torch.bfloat16,
+		I64=torch.int64, I32=torch.int32, I16=torch.int16, I8=torch.int8, U8=torch.uint8, BOOL=torch.bool)
+
+	def __init__(self, path, device=None):
+		with open(path, "rb") as f:
+			self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		size = int.from_bytes(self.mmap[:8], "little")
+		self.header = json.loads(self.mmap[8:8+size])
+		self.header.pop("__metadata__", None)
+		self.offset = 8+size
+		self.device = device
+
+	def keys(self):
+		return self.header.keys()
+
+	def get_tensor(self, key):
+		info = self.header[key]
+		begin, end = (self.offset+x for x in info["data_offsets"])
+		data = torch.empty(end-begin, dtype=torch.uint8)
+		data.numpy()[:] = np.frombuffer(self.mmap, dtype=np.uint8, count=end-begin, offset=begin)
+		data = data.view(self.dtypes[info["dtype"]]).reshape(info["shape"])
+		if hasattr(mmap, "MADV_DONTNEED"): # release mapped pages to keep rss bounded
+			begin -= begin % mmap.PAGESIZE
+			self.mmap.madvise(mmap.MADV_DONTNEED, begin, end-begin)
+		return data.to(self.device) if self.device else data
+
+def open_checkpoint(path, device=None):
+	from transformers.utils import cached_file
+	index = cached_file(path, "model.safetensors.index.json", _raise_exceptions_for_missing_entries=False)
+	if index is not None:
+		with open(index) as f:
+			weight_map = json.load(f)["weight_map"]
+	else:
+		weight_map = dict.fromkeys(SafetensorsFile(cached_file(path, "model.safetensors")).keys(), "model.safetensors")
+	files = {x: SafetensorsFile(cached_file(path, x), device=device) for x in set(weight_map.values())}
+	return {key: files[x] for key, x in weight_map.items()}
+
+def file_stats(path):
+	# size and mtime of a file or of the files in a folder, to detect changes without reading them
+	path = Path(path)
+	if path.is_dir():
+		return {x.name: file_stats(x) for x in sorted(path.iterdir()) if x.is_file()}
+	return [path.stat().st_size, path.stat().st_mtime_ns]
+
+def checkpoint_stats(path):
+	# file_stats of a model folder or cached hub model, or None if it isn't found
+	from transformers.utils import cached_file
+	try:
+		config = cached_file(path, "config.json", _raise_exceptions_for_missing_entries=False)
+	except OSError:
+		return None
+	return file_stats(Path(config).parent) if config is not None else None
+
+def export_lm(model, folder, force_write=False, quantize=None, max_positions=None, jobs=1, checkpoint=None,
+		max_memory=256<<20, codec=None, dedup=False, plan=None, error_budget=None, evaluate=None,
+		quantize_bits=8, quantize_group_size=None, threads=0, atlas=None):
+	# max_positions limits every position-dependent tensor to the target context, and is recorded in config.json
+	# quantize_bits is 8 for custom int8, or 4 for 4-bit groups in the layout of GPTQ. quantize_group_size defaults to 4 and 32
+	# threads > 0 pipelines the export with that many encoder threads, when jobs is 1
+	# atlas is "model" or "layer" to pack 1-D float tensors into one texture per model or per layer, indexed in config.json
+	# plan is {name: {format, group_size}} from quantize_plan.json. error_budget makes a new plan, measuring
+	# the logit drift of evaluate() if it's given
+	assert quantize_group_size is None or quantize_group_size % 4 == 0, f"group_size {quantize_group_size} should be a multiple of 4"
 	os.makedirs(folder, exist_ok=True)
 	print(folder/"config.json")
+	config = model.config.to_dict()
+	if max_positions is not None:
+		config["max_positions"] = max_positions
 	with open(folder/"config.json", "w") as f:
-		json.dump(model.config.to_dict(), f, indent=2, sort_keys=True)
+		json.dump(config, f, indent=2, sort_keys=True)
 
 	# apply weight parametrizations (in vits)
-	for name, layer in model.named_modules():
-		parametrizations = getattr(layer, "parametrizations", None)
-		if isinstance(parametrizations, torch.nn.ModuleDict):
-			for key in list(parametrizations):
-				torch.nn.utils.parametrize.remove_parametrizations(layer, key)
+	with span("parametrizations"):
+		for name, layer in model.named_modules():
+			parametrizations = getattr(layer, "parametrizations", None)
+			if isinstance(parametrizations, torch.nn.ModuleDict):
+				if checkpoint is not None:
+					raise NotImplementedError("parametrizations are not supported in streaming mode")
+				for key in list(parametrizations):
+					torch.nn.utils.parametrize.remove_parametrizations(layer, key)
 
 	gptq_layers = {}
-	unpack = lambda x: unpack_gptq(gptq_layers[id(x)]) if id(x) in gptq_layers else x
+	checkpoint_keys = {}
+	def unpack(x):
+		if id(x) in gptq_layers:
+			with span("unpack", format="gptq"):
+				return unpack_gptq(gptq_layers[id(x)])
+		if id(x) in checkpoint_keys:
+			key = checkpoint_keys[id(x)]
+			with span("unpack", format="checkpoint", bytes_in=x.numel()*x.element_size()):
+				return checkpoint[key].get_tensor(key).to(x.dtype)
+		return x
+	def defer(fn, data, *args):
+		def thunk():
+			x = unpack(data)
+			with span("transform"):
+				return fn(x, *args)
+		thunk.fn, thunk.data, thunk.args = fn, data, args # for mapping back to parameters
+		return thunk
+
+	source = model.state_dict()
+	if checkpoint is not None:
+		# map empty parameters (and their tied aliases) to checkpoint keys
+		aliases = {}
+		for name, param in model.named_parameters(remove_duplicate=False):
+			aliases.setdefault(id(param), []).append(name)
+		aliases = {name: names for names in aliases.values() for name in names}
+		prefix = f"{model.base_model_prefix}."
+		for name, data in source.items():
+			if not data.is_meta:
+				continue
+			keys = [key for x in aliases.get(name, [name]) for key in (x, x.removeprefix(prefix)) if key in checkpoint]
+			if not keys:
+				raise KeyError(f"{name} is not found in checkpoint")
+			checkpoint_keys[id(data)] = keys[0]
 
-	state_dict = dict(model.state_dict())
+	state_dict = dict(source)
 	for name, layer in model.named_modules():
 		# RotaryEmbedding => Linear
 		if hasattr(layer, "inv_freq"):
-			if hasattr(layer, "cos_cached"): # deprecated in torch 4.39
-				cos_cached, sin_cached = layer.cos_cached, layer.sin_cached
-			elif hasattr(layer, "_cached_cos"): # TODO: OpenELMRotaryEmbedding
-				cos_cached, sin_cached = layer._cached_cos[0,0], layer._cached_sin[0,0]
-			else:
-				pos_id = torch.arange(min(model.config.max_position_embeddings, max_positions),
-					dtype=torch.float32, device=model.device).unsqueeze(0)
-				cos_cached, sin_cached = (x[0] for x in layer(pos_id, pos_id))
-			half_dim = cos_cached.shape[-1]//2
-			weight = torch.cat(( # pad rotary weights as complex numbers
-				torch.nn.functional.pad(cos_cached[:max_positions, :half_dim], (0, -half_dim%2), value=1),
-				torch.nn.functional.pad(sin_cached[:max_positions, :half_dim], (0, -half_dim%2), value=0)), dim=-1)
+			with span("rotary", tensor=f"{name}.weight"):
+				weight = rotary_weight(model, layer, max_positions or 16384)
 			name0 = re.sub(r"[.]\d+[.]", ".0.", name, count=1)
 			if f"{name0}.weight" in state_dict and torch.allclose(weight, state_dict[f"{name0}.weight"]):
 				pass # skip duplicate weights to save space
@@ -152,154 +467,365 @@ def export_lm(model, folder, force_write=False, quantize=None, max_positions=163
 			for key in ("qweight", "qzeros", "scales", "g_idx"):
 				del state_dict[f"{name}.{key}"]
 
-	# model-specific transform
+	# model-specific transform, deferred until each tensor is written
 	model_type = model.config.model_type
 	if model_type in ["gpt2", "gpt_neo"]:
 		for name, data in list(state_dict.items()):
 			if name in ["transformer.wte.weight", "lm_head.weight"]:
-				if name == "lm_head.weight" and torch.allclose(data, model.state_dict()["transformer.wte.weight"]):
+				if name == "lm_head.weight" and torch.allclose(unpack(data), unpack(source["transformer.wte.weight"])):
 					pass # skip duplicate weights to save space
 				else:
-					state_dict[f"{name}.T"] = unpack(data).T
+					state_dict[f"{name}.T"] = defer(torch.t, data)
 			else:
 				if model_type == "gpt2" and re.search(r"(c_fc|c_proj|c_attn)[.]weight$", name):
 					# Conv1D => Linear
-					state_dict[name] = unpack(data).transpose(0,1)
+					state_dict[name] = defer(torch.transpose, data, 0, 1)
+				elif name == "transformer.wpe.weight" and max_positions is not None:
+					state_dict[name] = defer(lambda x: x[:max_positions], data)
 				continue
 			del state_dict[name]
 	elif model_type == "gpt_neox":
 		for name, data in list(state_dict.items()):
 			if name in ["gpt_neox.embed_in.weight", "embed_out.weight"]:
-				state_dict[f"{name}.T"] = unpack(data).T
+				state_dict[f"{name}.T"] = defer(torch.t, data)
 			else:
 				if m := re.fullmatch(r"(.*[.]\d+[.]attention)[.]query_key_value[.](weight|bias)", name):
-					state_dict[name] = unpack(data).view(model.config.num_attention_heads, 3, -1).\
-						transpose(0,1).reshape_as(data)
+					state_dict[name] = defer(lambda x: x.view(model.config.num_attention_heads, 3, -1).\
+						transpose(0,1).reshape_as(x), data)
 				continue
 			del state_dict[name]
 	elif model_type in ["gemma", "llama", "mistral", "phi", "phi3", "qwen2", "stablelm"]:
 		for name, data in list(state_dict.items()):
 			if name in ["model.embed_tokens.weight", "lm_head.weight"]:
-				if name == "lm_head.weight" and torch.allclose(data, model.state_dict()["model.embed_tokens.weight"]):
+				if name == "lm_head.weight" and torch.allclose(unpack(data), unpack(source["model.embed_tokens.weight"])):
 					pass # skip duplicate weights to save space
 				else:
-					state_dict[f"{name}.T"] = unpack(data).T
+					state_dict[f"{name}.T"] = defer(torch.t, data)
 			else:
 				if m := re.fullmatch(r"(.*[.]\d+[.]self_attn)[.]([qkv]_proj[.](weight|bias)|o_proj[.]weight)", name):
 					head_dim = getattr(model.get_submodule(m[1]), "head_dim", 0)
 					if head_dim%4 != 0: # pad head_dim and half rotary dim
 						half_dim = model.get_submodule(m[1]).rotary_emb.dim//2
-						view = unpack(data).view(data.shape[0], -1, head_dim, 1) if m[2].startswith("o_proj")\
-							else unpack(data).view(1, -1, head_dim, data.numel() // data.shape[0])
-						view = torch.cat((
-							torch.nn.functional.pad(view[:, :, 0*half_dim:1*half_dim], (0,0, 0,-half_dim%2)),
-							torch.nn.functional.pad(view[:, :, 1*half_dim:2*half_dim], (0,0, 0,-half_dim%2)),
-							torch.nn.functional.pad(view[:, :, 2*half_dim:], (0,0, 0,-(head_dim-2*half_dim)%4)),
-						), dim=2)
-						state_dict[name] = view.view(data.shape[0], -1) if m[2].startswith("o_proj")\
-										else view.view(-1, *data.shape[1:])
+						state_dict[name] = defer(pad_head_dim, data, head_dim, half_dim, m[2].startswith("o_proj"))
 				elif m := re.fullmatch(r".*(_layernorm|\bnorm)[.]weight", name):
 					if model_type == "gemma":
-						state_dict[name] = 1.0 + unpack(data).float() # convert residue weight
+						state_dict[name] = defer(lambda x: 1.0 + x.float(), data) # convert residue weight
 				continue
 			del state_dict[name]
 	elif model_type in ["openelm"]:
 		for name, data in list(state_dict.items()):
 			if name in ["transformer.token_embeddings.weight", "lm_head.weight"]:
-				state_dict[f"{name}.T"] = unpack(data).T
+				state_dict[f"{name}.T"] = defer(torch.t, data)
 			else:
 				continue
 			del state_dict[name]
 	elif model_type in ["t5"]:
-		shared_weight = model.state_dict().get("shared.weight")
+		shared_weight = source.get("shared.weight")
 		for name, data in list(state_dict.items()):
 			if name in ["shared.weight", "encoder.embed_tokens.weight", "decoder.embed_tokens.weight", "lm_head.weight"]:
-				if name != "shared.weight" and shared_weight is not None and torch.allclose(data, shared_weight):
+				if name != "shared.weight" and shared_weight is not None and torch.allclose(unpack(data), unpack(shared_weight)):
 					pass # skip duplicate weights to save space
 				else:
-					state_dict[f"{name}.T"] = unpack(data).T
+					state_dict[f"{name}.T"] = defer(torch.t, data)
 			elif m := re.fullmatch(r"(.*[.]SelfAttention)[.]relative_attention_bias[.]weight", name):
-				layer = model.get_submodule(m[1])
-				relative_position_bucket = layer._relative_position_bucket(
-					torch.arange(-layer.relative_attention_max_distance, layer.relative_attention_max_distance,
-						dtype=torch.long, device=layer.q.weight.device),
-					bidirectional=(not layer.is_decoder),
-					num_buckets=layer.relative_attention_num_buckets,
-					max_distance=layer.relative_attention_max_distance,
-				)
 				# bake buckets into weights
-				state_dict[f"{name}.T"] = layer.relative_attention_bias(relative_position_bucket).permute(1, 0)[None,:,:]
+				state_dict[f"{name}.T"] = defer(bake_relative_attention_bias, data, model.get_submodule(m[1]), max_positions)
 			else:
 				continue
 			del state_dict[name]
 	elif model_type in ["vits"]:
 		for name, data in list(state_dict.items()):
 			if name in ["text_encoder.embed_tokens.weight", "text_encoder.project.weight"]:
-				state_dict[f"{name}.T"] = unpack(data).transpose(0,1)
+				state_dict[f"{name}.T"] = defer(torch.transpose, data, 0, 1)
 			elif m := re.fullmatch(r".*attention[.]emb_rel_[kv]", name):
-				state_dict[f"{m[0]}.weight"] = unpack(data).squeeze(0)
+				state_dict[f"{m[0]}.weight"] = defer(torch.squeeze, data, 0)
 			elif re.fullmatch(r"(text_encoder|flow|decoder).*", name):
 				continue
 			del state_dict[name]
 	else:
 		raise NotImplementedError(f"{model_type=}")
 
-	for name in list(state_dict.keys()):
-		# reduce memory use
-		data = state_dict.pop(name)
-		print(f"\t{name}\t{tuple(data.shape)} {data.dtype}")
-		assert (re.search(r"\.weight(\.T)?$", name) and len(data.shape) in (2,3))\
-			or (re.search(r"\.(weight|bias)$", name) and len(data.shape) == 1)
+	# tensors whose hash and format match the manifest are not written again
+	try:
+		with open(folder/"manifest.json") as f:
+			old_manifest = json.load(f)
+	except FileNotFoundError:
+		old_manifest = {}
+	if old_manifest.get("version") != CONVERTER_VERSION:
+		old_manifest = {}
+	manifest = {}
 
-		quantizable = bool(re.search(r"\.weight(\.T)?$", name)) and len(data.shape) == 2
-		quantizable = quantizable and not re.search(r"(rotary_emb|pos_embedding|relative_attention_bias)\.weight", name)
-		quantizable = quantizable and quantize is not None and quantize(name, data.shape)
+	int8_args = dict(max_memory=max_memory)
+	report = []
+	pool = quantizer = None
+	if jobs > 1:
+		pool = ProcessPoolExecutor(jobs, initializer=init_worker)
+		pending = deque()
+	elif threads > 0:
+		# pipeline: this thread transforms tensors and starts device to host copies, a thread quantizes and pads them,
+		# and encoder threads write textures. torch and cv2 release the GIL, so the stages overlap
+		quantizer, encoder = ThreadPoolExecutor(1), ThreadPoolExecutor(threads)
+		pending = deque()
+	def wait(future):
+		if quantizer is not None: # export_tensor result of encoder futures
+			return [x for x in (f.result() for f in future.result()) if x is not None]
+		if profiler is None:
+			return future.result()
+		result, events = future.result()
+		profiler.events += events
+		return result
 
-		filenames = []
-		if id(data) in gptq_layers:
+	load = lambda x: x() if callable(x) else x if id(x) in gptq_layers else unpack(x)
+	def same_tensor(x, data):
+		# exact check after a digest match. x is reloaded rather than keeping every unique tensor in memory
+		if id(x) in gptq_layers or id(data) in gptq_layers:
+			x, y = gptq_layers.get(id(x)), gptq_layers.get(id(data))
+			return x is not None and y is not None and x.bits == y.bits and x.group_size == y.group_size\
+				and all(torch.equal(getattr(x, k), getattr(y, k)) for k in ("qweight", "qzeros", "scales", "g_idx"))
+		return torch.equal(load(x).to(data.device, data.dtype), data)
+	uniques = {} # (digest, fmt, group_size) => (name, unloaded tensor)
+	aliases = {}
+	atlas_tensors = {} # atlas texture => [(name, array)]
+
+	def logit_drift(raw, reference):
+		# returns a function measuring the logit drift with a tensor replaced, or None if the tensor
+		# is not a parameter or its transpose
+		if callable(raw) and (raw.fn is torch.t or (raw.fn is torch.transpose and raw.args == (0, 1))):
+			param, inverse = raw.data, torch.t
+		else:
+			param, inverse = raw, lambda x: x
+		if not any(param is x for x in source.values()) or param.is_meta:
+			return None
+		def drift(x):
+			saved = param.clone()
+			param.copy_(inverse(x.to(param.device, param.dtype)))
+			try:
+				logits = evaluate().double()
+			finally:
+				param.copy_(saved)
+			return (torch.sqrt(torch.mean((logits - reference)**2)) / torch.sqrt(torch.mean(reference**2))).item()
+		return drift
+
+	# choose the format of each tensor to minimize texture bytes within the error budget
+	if error_budget is not None:
+		reference = evaluate().double() if evaluate is not None else None
+		candidates = {}
+		for name, raw in state_dict.items():
+			if id(raw) in gptq_layers:
+				continue
+			with span("plan", tensor=name):
+				drift = logit_drift(raw, reference) if evaluate is not None else None
+				if evaluate is not None and drift is None:
+					continue # keep the default format if the drift can't be measured
+				data = load(raw)
+				candidates[name] = plan_candidates(data, int8_args if can_quantize(name, data.shape) else None, drift)
+		choice = solve_plan(candidates, error_budget)
+		plan = {}
+		for name, k in choice.items():
+			fmt, _, group_size = k.partition("/")
+			plan[name] = dict(format=fmt, **(dict(group_size=int(group_size)) if group_size else {}),
+				bytes=candidates[name][k][0], error=candidates[name][k][1], candidates=candidates[name])
+		total_bytes = sum(x["bytes"] for x in plan.values())
+		total_error = sum(x["error"] for x in plan.values())
+		print(f"plan: {total_bytes/2**20:.1f}MiB, error {total_error:.4g} of {error_budget:.4g},"
+			f" {dict(Counter(choice.values()))}")
+		print(folder/"quantize_plan.json")
+		with open(folder/"quantize_plan.json", "w") as f:
+			json.dump(dict(budget=error_budget, metric="logits" if evaluate is not None else "qerr",
+				bytes=total_bytes, error=total_error, tensors=plan), f, indent=2)
+
+	# tensors before formatting depend only on these inputs. if they are unchanged, entries are checked before loading
+	stats = checkpoint_stats(model.name_or_path)
+	inputs = None if stats is None else dict(checkpoint=stats, dtype=str(model.dtype), max_positions=max_positions,
+		dedup=dedup, plan={name: x["format"] for name, x in plan.items()} if plan is not None else None)
+	same_inputs = inputs is not None and old_manifest.get("inputs") == inputs
+	old_manifest = old_manifest.get("tensors", {})
+
+	def tensor_format(name, shape, gptq):
+		# returns (quantizable, bits, group_size, dtype to convert to or None, format, file names)
+		quantizable = can_quantize(name, shape) and quantize is not None and quantize(name, shape)
+		bits = quantize_bits
+		group_size = quantize_group_size or (4 if bits == 8 else 32)
+		dtype = None
+		if plan is not None and name in plan and not gptq:
+			quantizable = plan[name]["format"] == "int8"
+			bits = 8
+			group_size = plan[name].get("group_size", 4)
+			assert not quantizable or can_quantize(name, shape), f"{name} can't be quantized"
+			if not quantizable:
+				dtype = getattr(torch, plan[name]["format"])
+		if gptq or (quantizable and bits == 4):
 			filenames = (f"{name}.png", f"{name}.q8.exr", f"{name}.q8.idx.exr")
 		elif quantizable:
 			filenames = (f"{name}.exr", f"{name}.q8.png", f"{name}.q8.idx.exr")
 		else:
 			filenames = (f"{name}.exr",)
+		fmt = "gptq" if gptq else f"int{bits}" if quantizable else "float"
+		return quantizable, bits, group_size, dtype, fmt, filenames
+	def manifest_entry(digest, dtype, shape, fmt, filenames, group_size):
+		# group_size is recorded for quantized tensors only, and only if it isn't the default 4
+		entry = dict(source=digest, dtype=dtype, shape=shape, format=fmt, files=list(filenames))
+		if group_size and group_size != 4:
+			entry["group_size"] = group_size
+		return entry
+	def files_exist(name, filenames):
+		return all((folder/x).exists() == (x in filenames) for x in [f"{name}.exr", f"{name}.png", f"{name}.q8.exr", f"{name}.q8.png"])
 
-		possible_filenames = [f"{name}.exr", f"{name}.png", f"{name}.q8.exr", f"{name}.q8.png"]
-		if not force_write and all((folder/x).exists() == (x in filenames) for x in possible_filenames):
+	for name in list(state_dict.keys()):
+		if profiler is not None:
+			profiler.tensor = name
+		# reduce memory use
+		raw = state_dict.pop(name)
+		old = old_manifest.get(name) if same_inputs and not force_write else None
+		if old is not None and "alias" not in old and not (atlas is not None and len(old["shape"]) == 1):
+			# the tensor is unchanged in the same checkpoint, so its entry is known before loading it
+			quantizable, bits, group_size, dtype, fmt, filenames = tensor_format(name, old["shape"], id(raw) in gptq_layers)
+			entry = manifest_entry(old["source"], old["dtype"], old["shape"], fmt, filenames, quantizable and group_size)
+			if codec is not None:
+				entry["codec"] = codec
+			if entry == old and files_exist(name, filenames):
+				manifest[name] = old
+				if dedup:
+					uniques.setdefault((old["source"], fmt, group_size), (name, raw))
+				if profiler is not None:
+					profiler.formats[name] = None
+				continue
+		data = load(raw)
+		print(f"\t{name}\t{tuple(data.shape)} {data.dtype}")
+		assert (re.search(r"\.weight(\.T)?$", name) and len(data.shape) in (2,3))\
+			or (re.search(r"\.(weight|bias)$", name) and len(data.shape) == 1)
+
+		quantizable, bits, group_size, dtype, fmt, filenames = tensor_format(name, data.shape, id(data) in gptq_layers)
+		if dtype is not None:
+			data = data.to(dtype)
+
+		layer = gptq_layers.get(id(data))
+		with span("hash"):
+			digest = hash_tensors(layer.qweight, layer.qzeros, layer.scales, layer.g_idx) if layer else hash_tensors(data)
+
+		# identical tensors are written once, and the others become aliases of the first one
+		target = uniques.get((digest, fmt, group_size)) if dedup else None
+		if target is not None:
+			with span("dedup"):
+				target = target[0] if same_tensor(target[1], data) else None
+		if target is not None:
+			aliases[name] = target
+			filenames = ()
+		elif dedup:
+			uniques.setdefault((digest, fmt, group_size), (name, raw))
+		del raw
+		in_atlas = atlas is not None and target is None and len(data.shape) == 1 and fmt == "float"
+		if in_atlas:
+			filenames = ()
+
+		manifest[name] = manifest_entry(digest, str(data.dtype), list(data.shape), fmt, filenames, quantizable and group_size)
+		if target is not None:
+			manifest[name]["alias"] = target
+		if in_atlas: # written with the other tensors of its atlas after the loop
+			manifest[name]["atlas"] = atlas_name(name, atlas)
+			atlas_tensors.setdefault(manifest[name]["atlas"], []).append((name, data.cpu().numpy()))
+		if codec is not None:
+			manifest[name]["codec"] = codec
+		if not force_write and old_manifest.get(name) == manifest[name] and files_exist(name, filenames):
+			if profiler is not None:
+				profiler.formats[name] = None
 			continue
-		possible_filenames.append(f"{name}.q8.idx.exr")
-		for x in possible_filenames:
+		if profiler is not None:
+			profiler.formats[name] = manifest[name]["format"]
+		for x in [f"{name}.exr", f"{name}.png", f"{name}.q8.exr", f"{name}.q8.png", f"{name}.q8.idx.exr"]:
 			(folder/x).unlink(missing_ok=True)
+		if target is not None or in_atlas:
+			print(f"\t\t=> {target or manifest[name]['atlas']}")
+			continue
 
+		quant_args = dict(int8_args, group_size=group_size, bits=bits) if quantizable else None
 		if id(data) in gptq_layers:
-			arrays = export_gptq(gptq_layers[id(data)])
-		elif quantizable:
-			arrays = export_custom_int8(data)
+			with span("quantize", format="gptq") as info:
+				arrays = export_gptq(gptq_layers[id(data)])
+				info["bytes_out"] = sum(x.nbytes for x in arrays if x is not None)
+			data = quant_args = None
+		elif quantizable and quantizer is None and (pool is None or data.device.type != "cpu"):
+			with span("quantize", format=fmt, bytes_in=data.nbytes) as info:
+				arrays = export_quantized(data, **quant_args) # quantize on device
+				info["bytes_out"] = sum(x.nbytes for x in arrays if x is not None)
+			data = quant_args = None
 		else:
-			arrays = (data.cpu().numpy(),)
-		for filename, array in zip(filenames, arrays):
-			if array is None:
-				continue
-			print(f"\t\t{filename}\t{tuple(array.shape)}")
-			if len(array.shape) == 1:
-				array = pad_align(array, [4]).reshape(1, -1, 4)
-			elif len(array.shape) == 2:
-				array = pad_align(array, [1, 4]).reshape(array.shape[0], -1, 4)
-			elif len(array.shape) == 3:
-				array = pad_align(array, [1, 4, 1] if array.shape[-1] == 1 else [1, 1, 4]).reshape(array.shape[0], -1, 4)
-			else:
-				raise KeyError(f"unexpected {array.shape}")
+			arrays = None
+		if pool is None and quantizer is None:
+			report += export_tensor(folder, filenames, data, quant_args, arrays, codec)
+			continue
+		# bound the number of tensors in flight
+		while len(pending) >= (2*jobs if pool is not None else threads+1):
+			report += wait(pending.popleft())
+		if quantizer is not None:
+			event = None
+			if data is not None and quant_args is None: # quantize on device in the next stage
+				with span("to_host", bytes_in=data.nbytes):
+					data, event = copy_to_host(data)
+			pending.append(quantizer.submit(in_thread, name, pipeline_tensor, event, encoder, name,
+				folder, filenames, data, quant_args, arrays, codec))
+			continue
+		args = (folder, filenames, data, quant_args, arrays, codec)
+		pending.append(pool.submit(export_tensor, *args) if profiler is None else\
+			pool.submit(profile_call, name, export_tensor, *args))
+
+	if profiler is not None:
+		profiler.tensor = None
+	if pool is not None or quantizer is not None:
+		while pending:
+			report += wait(pending.popleft())
+	if pool is not None:
+		pool.shutdown()
+	if quantizer is not None:
+		quantizer.shutdown()
+		encoder.shutdown()
+
+	atlas_index = []
+	for texture, tensors in atlas_tensors.items():
+		print(f"\t{texture}\t{len(tensors)} tensors")
+		array, entries = pack_atlas(tensors)
+		atlas_index += [dict(name=name, texture=texture, offset=offset, size=size) for name, offset, size in entries]
+		report += export_tensor(folder, [f"{texture}.exr"], None, arrays=(array,), codec=codec)
+	for x in folder.iterdir():
+		if re.fullmatch(r"(.*[.])?atlas[.]exr", x.name) and x.name[:-4] not in atlas_tensors:
+			x.unlink()
+	if atlas is not None:
+		# aliases of atlas tensors are entries of the index instead of aliases.json
+		members = {x["name"]: x for x in atlas_index}
+		atlas_index += [dict(members[target], name=name) for name, target in aliases.items() if target in members]
+		aliases = {name: target for name, target in aliases.items() if target not in members}
+		config["atlas"] = atlas_index
+		with open(folder/"config.json", "w") as f:
+			json.dump(config, f, indent=2, sort_keys=True)
 
-			# tile wide texture
-			MAX_SIZE = 16384
-			if array.shape[1] > MAX_SIZE:
-				lvl = 0
-				while ((array.shape[1]-1)>>lvl)+1 > MAX_SIZE:
-					lvl += 1
-				array = pad_align(array, [1, 1<<lvl, 1]).reshape(array.shape[0], -1, 1<<lvl, array.shape[2])\
-					.transpose(0, 2, 1, 3).reshape(array.shape[0]<<lvl, -1, array.shape[2])
+	if codec is not None:
+		# keep the entries of files skipped in this run
+		try:
+			with open(folder/"codec_report.json") as f:
+				old_report = json.load(f)
+		except FileNotFoundError:
+			old_report = {}
+		files = {x for entry in manifest.values() for x in entry["files"]} - {x["file"] for x in report}
+		if old_report.get("policy") == codec:
+			report += [x for x in old_report["files"] if x["file"] in files and (folder/x["file"]).exists()]
+		report.sort(key=lambda x: x["file"])
+
+		total_size = sum(x["size"] for x in report)
+		counts = {x: sum(y["codec"] == x for y in report) for x in sorted({y["codec"] for y in report})}
+		print(f"codec: {codec} {len(report)} files, {total_size/2**20:.1f}MiB, {counts}")
+		with open(folder/"codec_report.json", "w") as f:
+			json.dump(dict(policy=codec, size=total_size, files=report), f, indent=2)
+
+	if aliases:
+		print(f"dedup: {len(aliases)} aliases")
+		with open(folder/"aliases.json", "w") as f:
+			json.dump(dict(aliases=[dict(name=k, target=v) for k, v in aliases.items()]), f, indent=2)
+	else:
+		(folder/"aliases.json").unlink(missing_ok=True)
 
-			array = array[::-1] # flip Y for d3d
-			imwrite(folder/filename, array)
+	with open(folder/"manifest.json.tmp", "w") as f:
+		json.dump(dict(version=CONVERTER_VERSION, inputs=inputs, tensors=manifest), f, indent=2)
+	os.replace(folder/"manifest.json.tmp", folder/"manifest.json")
 
 def export_tokenizer(tokenizer, folder):
 	if tokenizer.is_fast:
@@ -313,7 +839,8 @@ def export_tokenizer(tokenizer, folder):
 
 	# extract vocab
 	vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer.get_vocab()))))
-	fixed = [x.encode() if x in tokenizer.added_tokens_encoder else\
+	added_tokens_encoder = tokenizer.added_tokens_encoder # property rebuilt on every access
+	fixed = [x.encode() if x in added_tokens_encoder else\
 		bytes((int(x[1:-1], 16),)) if re.fullmatch(r"<0x[0-9A-F]{2}>", x) else None for x in vocab]
 	if fast_tokenizer is None:
 		vocab = [x.encode() for x in vocab]
@@ -322,22 +849,42 @@ def export_tokenizer(tokenizer, folder):
 		byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
 		vocab = [fixed[i] or bytes(byte_decoder[c] for c in x) for i,x in enumerate(vocab)]
 	else:
+		# decode after a prefix token to keep leading spaces, batched in rust when decode isn't overridden
+		from transformers import PreTrainedTokenizerFast
+		ids = [[0, i] for i in range(len(vocab))]
+		if tokenizer.is_fast and type(tokenizer)._decode is PreTrainedTokenizerFast._decode:
+			texts = fast_tokenizer.decode_batch(ids, skip_special_tokens=False)
+			if tokenizer.clean_up_tokenization_spaces:
+				texts = [tokenizer.clean_up_tokenization(x) for x in texts]
+		else:
+			texts = tokenizer.batch_decode(ids)
 		prefix_len = len(tokenizer.decode([0]))
-		vocab = [fixed[i] or tokenizer.decode([0, i])[prefix_len:].encode() for i in range(len(vocab))]
+		vocab = [fixed[i] or x[prefix_len:].encode() for i, x in enumerate(texts)]
 
 	# extract model
 	merges = None
+	merged = None
 	weights = None
 	if fast_tokenizer is not None:
 		config = json.loads(fast_tokenizer.to_str())
 		if type(fast_tokenizer.model).__name__ == "BPE":
-			merges = [tokenizer.convert_tokens_to_ids(x.split(" ", 1)) for x in config["model"]["merges"]]
+			pairs = [x.split(" ", 1) if isinstance(x, str) else x for x in config["model"]["merges"]]
+			ids = tokenizer.convert_tokens_to_ids([x for pair in pairs for x in pair] + ["".join(x) for x in pairs])
+			merges = list(zip(ids[0:2*len(pairs):2], ids[1:2*len(pairs):2]))
+			merged = ids[2*len(pairs):]
 		elif type(fast_tokenizer.model).__name__ == "Unigram":
 			weights = [x[1] for x in config["model"]["vocab"]] # TODO
 		else:
 			raise NotImplementedError(f"model {type(fast_tokenizer.model)} is not supported")
 
-	added_tokens = [k for k, v in sorted(tokenizer.added_tokens_encoder.items(), key=lambda item: item[1])]
+	# pre-indexed merge table and packed vocab, loaded without parsing
+	os.makedirs(folder, exist_ok=True)
+	print(folder/"tokenizer.bytes")
+	with open(folder/"tokenizer.bytes", "wb") as f:
+		f.write(pack_tokenizer(vocab, [(i, j, k) for (i, j), k in zip(merges, merged)] if merges is not None else None,
+			byte_level=fast_tokenizer is not None and type(fast_tokenizer.decoder).__name__ == "ByteLevel"))
+
+	added_tokens = [k for k, v in sorted(added_tokens_encoder.items(), key=lambda item: item[1])]
 	vocab = ["".join(chr(b) for b in token) for token in vocab]
 	if merges is not None:
 		merges = [f"{vocab[i]} {vocab[j]}" for i, j in merges]
@@ -380,22 +927,44 @@ def export_tokenizer(tokenizer, folder):
 	with open(folder/"tokenizer.json", "w", encoding="utf-8") as f:
 		f.write(output)
 
+TESTCASE_PROMPT = (
+	"In a shocking finding, scientists discovered a herd of unicorns living in a remote, "
+	"previously unexplored valley, in the Andes Mountains. Even more surprising to the "
+	"researchers was the fact that the unicorns spoke perfect English."
+)
+
+def testcase_inputs(model, tokenizer, max_positions=None):
+	# model inputs of the testcase prompt, for measuring logit drift
+	input_ids = tokenizer(TESTCASE_PROMPT, return_tensors="pt", padding=False, add_special_tokens=False).input_ids.to(model.device).long()
+	input_ids = truncate_ids(input_ids, max_positions, "plan prompt")
+	if not hasattr(model, "encoder"):
+		return dict(input_ids=input_ids)
+	decoder_input_ids = torch.tensor([[model.generation_config.decoder_start_token_id]], device=model.device)
+	return dict(input_ids=input_ids, decoder_input_ids=decoder_input_ids)
+
+def truncate_ids(input_ids, max_positions, what):
+	# cuts the prompt to fit the position tables of an export with max_positions
+	if max_positions is not None and input_ids.shape[-1] > max_positions:
+		print(f"{what} is truncated from {input_ids.shape[-1]} to max_positions {max_positions} tokens")
+		return input_ids[..., :max_positions]
+	return input_ids
+
 @torch.no_grad()
-def export_testcase(model, tokenizer, folder, force_write=False):
+def export_testcase(model, tokenizer, folder, force_write=False, max_positions=None):
 	if not force_write and (folder/"testcase.json").exists():
-		return
+		with open(folder/"testcase.json") as f:
+			testcase = json.load(f)
+		if max_positions is None or len(testcase["input_ids"]) <= max_positions:
+			return
 
-	prompt = (
-		"In a shocking finding, scientists discovered a herd of unicorns living in a remote, "
-		"previously unexplored valley, in the Andes Mountains. Even more surprising to the "
-		"researchers was the fact that the unicorns spoke perfect English."
-	)
+	prompt = TESTCASE_PROMPT
 	o = {}
 
 	# run encoder
 	encoder_outputs = None
 	if hasattr(model, "encoder"):
 		encoder_input_ids = tokenizer(prompt, return_tensors="pt", padding=False, add_special_tokens=False).input_ids.to(model.device)
+		encoder_input_ids = truncate_ids(encoder_input_ids, max_positions, "testcase encoder prompt")
 		encoder_outputs = model.encoder(input_ids=encoder_input_ids, return_dict=True)
 		o["encoder_input_ids"] = encoder_input_ids[0].tolist()
 		o["encoder_hidden_states"] = encoder_outputs.last_hidden_state[0].reshape(-1).tolist()
@@ -406,6 +975,7 @@ def export_testcase(model, tokenizer, folder, force_write=False):
 		decoder_start_token_id = model.generation_config.decoder_start_token_id
 		if input_ids.shape[1] == 0 or (input_ids[:, 0] != decoder_start_token_id).all().item():	
 			input_ids = torch.cat([torch.ones((input_ids.shape[0], 1), dtype=torch.long, device=input_ids.device) * decoder_start_token_id, input_ids], dim=-1)
+	input_ids = truncate_ids(input_ids, max_positions, "testcase prompt")
 
 	# run model
 	outputs = model(**model.prepare_inputs_for_generation(input_ids, return_dict=True,
@@ -419,8 +989,69 @@ def export_testcase(model, tokenizer, folder, force_write=False):
 	with open(folder/"testcase.json", "w") as f:
 		json.dump(o, f)
 
-def main():
-	from transformers import AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoModelForTextToWaveform, AutoTokenizer
+GOLDEN_PROMPTS = [
+	TESTCASE_PROMPT,
+	"Once upon a time, there was a little girl named Lily.",
+	"def fibonacci(n):\n\treturn n if n < 2 else fibonacci(n-1) + fibonacci(n-2)",
+	"1, 1, 2, 3, 5, 8, 13, 21, 34,",
+	"Der schnelle braune Fuchs springt über den faulen Hund. 素早い茶色の狐",
+]
+
+def pad_batch(batch, value):
+	# right padding, so that positions of causal models don't depend on the padding
+	lengths = [len(x) for x in batch]
+	ids = torch.full((len(batch), max(lengths)), value, dtype=torch.long)
+	for i, x in enumerate(batch):
+		ids[i, :len(x)] = torch.tensor(x, dtype=torch.long)
+	return ids, torch.tensor(lengths), torch.arange(ids.shape[1]) < torch.tensor(lengths)[:, None]
+
+def half_array(x):
+	# fp16 unless it overflows
+	x = x.detach().float().cpu()
+	return (x.half() if x.abs().max() < 65504 else x).numpy()
+
+@torch.no_grad()
+def export_golden(model, tokenizer, folder, prompts=GOLDEN_PROMPTS, kv=False, max_positions=None):
+	# golden.npz: hidden states of every layer and position for a batch of prompts, in one padded forward pass.
+	# hidden_states[i] is the input of layer i, and the last one is the normalized output, like output_hidden_states
+	# prompts longer than max_positions are truncated, and prompts keeps the full text
+	o = dict(prompts=np.array(prompts))
+	pad = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+	batch = [tokenizer(x, add_special_tokens=False).input_ids for x in prompts]
+	batch = [truncate_ids(np.array(x), max_positions, f"golden prompt {i}").tolist() for i, x in enumerate(batch)]
+	inputs = {}
+	if hasattr(model, "encoder"):
+		input_ids, lengths, mask = pad_batch(batch, pad)
+		inputs = dict(attention_mask=mask.to(model.device))
+		o["encoder_input_ids"], o["encoder_lengths"] = input_ids.int().numpy(), lengths.int().numpy()
+		start = model.generation_config.decoder_start_token_id
+		batch = [truncate_ids(np.array([start] + x), max_positions, f"golden prompt {i}").tolist() for i, x in enumerate(batch)]
+	input_ids, lengths, mask = pad_batch(batch, pad)
+	if hasattr(model, "encoder"):
+		inputs.update(input_ids=torch.from_numpy(o["encoder_input_ids"]).long().to(model.device),
+			decoder_input_ids=input_ids.to(model.device), decoder_attention_mask=mask.to(model.device))
+	else:
+		inputs.update(input_ids=input_ids.to(model.device), attention_mask=mask.to(model.device))
+	outputs = model(**inputs, output_hidden_states=True, use_cache=kv, return_dict=True)
+
+	o["input_ids"], o["lengths"] = input_ids.int().numpy(), lengths.int().numpy()
+	hidden_states = outputs.decoder_hidden_states if hasattr(model, "encoder") else outputs.hidden_states
+	o["hidden_states"] = half_array(torch.stack(hidden_states))
+	if hasattr(model, "encoder"):
+		o["encoder_hidden_states"] = half_array(torch.stack(outputs.encoder_hidden_states))
+	o["logits"] = half_array(outputs.logits[torch.arange(len(batch)), lengths-1])
+	o["argmax"] = outputs.logits.argmax(dim=-1).int().cpu().numpy()
+	if kv:
+		cache = outputs.past_key_values
+		cache = cache.to_legacy_cache() if hasattr(cache, "to_legacy_cache") else cache
+		o["keys"] = half_array(torch.stack([x[0] for x in cache])) # self attention only, (layer, batch, head, position, dim)
+		o["values"] = half_array(torch.stack([x[1] for x in cache]))
+
+	os.makedirs(folder, exist_ok=True)
+	print(folder/"golden.npz")
+	np.savez_compressed(folder/"golden.npz", **o)
+
+def parse_args(argv=None):
 	import argparse
 	parser = argparse.ArgumentParser()
 	parser.add_argument('model', help='model id or path. for example: roneneldan/TinyStories-1M')
@@ -431,34 +1062,167 @@ def main():
 	parser.add_argument('--trust', action='store_true')
 	parser.add_argument('--force', action='store_true')
 	parser.add_argument('--quantize', type=float)
+	parser.add_argument('--quantize-bits', type=int, choices=[8, 4], default=8, help='8 for custom int8, 4 for 4-bit groups like GPTQ')
+	parser.add_argument('--group-size', type=int, help='number of weights sharing a scale in --quantize, a multiple of 4. default: 4 for 8 bits, 32 for 4 bits')
+	parser.add_argument('--jobs', type=int, default=1, help='number of processes for quantizing and encoding')
+	parser.add_argument('--threads', type=int, default=0, help='number of encoder threads overlapping with quantizing'
+		' and device transfer when --jobs is 1. default: 0, exporting tensors one by one')
+	parser.add_argument('--stream', action='store_true', help='read tensors one by one from safetensors without loading the model')
+	parser.add_argument('--max-memory', type=float, default=256, help='memory budget in MiB for quantizing a tensor')
+	parser.add_argument('--codec', choices=CODEC_POLICIES, help='choose lossless codec per texture by size and decode speed')
+	parser.add_argument('--profile', type=str, help='save time, memory and bytes of each stage and tensor to a json file')
+	parser.add_argument('--trace', type=str, help='save a chrome trace json file of conversion stages')
+	parser.add_argument('--atlas', choices=ATLAS_MODES, help='pack 1-D tensors like biases and norm weights into one texture'
+		' per model or per layer, indexed in config.json')
+	parser.add_argument('--dedup', action='store_true', help='write identical tensors once, and the others as aliases in aliases.json')
+	parser.add_argument('--max-positions', type=int, help='target context length. position tables are cut to this size')
+	parser.add_argument('--error-budget', type=float, help='choose float32/float16/int8 and group size per tensor for the fewest texture bytes'
+		' within this sum of relative errors, and save the plan to quantize_plan.json')
+	parser.add_argument('--plan-logits', action='store_true', help='measure errors as logit drift on the testcase prompt instead of weight error')
+	parser.add_argument('--plan', type=str, help='use formats from a quantize_plan.json')
+	parser.add_argument('--golden', action='store_true', help='save hidden states of every layer and position for a set of prompts to golden.npz')
+	parser.add_argument('--golden-prompts', type=str, help='text file of prompts for --golden, one per line with \\n for line breaks')
+	parser.add_argument('--golden-kv', action='store_true', help='also save the kv cache in golden.npz')
 	
-	args = parser.parse_args()
+	return parser.parse_args(argv)
 
-	folder = Path(args.folder)
-	if re.search(r"[/\\]$", args.folder):
-		folder /= Path(args.model).name
-	print(f"convert: {args.model} => {folder}")
-	disable_exllama()
+def stream_device(device):
+	# --device is the device_map of from_pretrained. streamed tensors go to the device where it places the first layers
+	if device in ("auto", "balanced", "balanced_low_0", "sequential"):
+		return "cuda" if torch.cuda.is_available() else None
+	return torch.device(device) if device else None
+
+def load_model(args):
+	# returns (auto_cls, model, tokenizer, checkpoint), or None if no auto class accepts the model
+	from transformers import AutoConfig, AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoModelForTextToWaveform, AutoTokenizer
+	checkpoint = open_checkpoint(args.model, device=stream_device(args.device)) if args.stream else None
 	errs = []
 	for auto_cls in [AutoModelForCausalLM, AutoModelForSeq2SeqLM, AutoModelForTextToWaveform]:
 		try:
-			model = auto_cls.from_pretrained(args.model, trust_remote_code=args.trust,
-				device_map=args.device or None, torch_dtype=getattr(torch, args.dtype) if args.dtype else None)
+			with span("load"):
+				if checkpoint is not None:
+					config = AutoConfig.from_pretrained(args.model, trust_remote_code=args.trust)
+					if getattr(config, "quantization_config", None) is not None:
+						raise NotImplementedError("quantized models are not supported in streaming mode")
+					with init_empty_weights():
+						model = auto_cls.from_config(config, trust_remote_code=args.trust,
+							torch_dtype=getattr(torch, args.dtype) if args.dtype else None)
+					# config.json records the dtype like from_pretrained without device_map: --dtype if it's given, or none
+					model.config.torch_dtype = getattr(torch, args.dtype) if args.dtype else None
+				else:
+					model = auto_cls.from_pretrained(args.model, trust_remote_code=args.trust,
+						device_map=args.device or None, torch_dtype=getattr(torch, args.dtype) if args.dtype else None)
 		except ValueError as e:
 			errs.append(e)
 			continue
 		else:
 			tokenizer = AutoTokenizer.from_pretrained(args.tokenizer or args.model)
-			quantize = (lambda name, shape: np.prod(shape) >= args.quantize*1024*1024) if args.quantize else None
-			print(f"model: {type(model)}")
-			export_lm(model, folder, force_write=bool(args.force), quantize=quantize)
-			if tokenizer is not None:
-				export_tokenizer(tokenizer, folder)
-			if auto_cls in [AutoModelForCausalLM, AutoModelForSeq2SeqLM]:
-				export_testcase(model, tokenizer, folder, force_write=bool(args.force))
-			return
+			return auto_cls, model, tokenizer, checkpoint
 	for e in errs:
 		print(e)
+	return None
+
+def convert_inputs(args):
+	# the checkpoint and the arguments that the output depends on, or None if the checkpoint isn't found
+	stats = checkpoint_stats(args.model)
+	if stats is None:
+		return None
+	inputs = {k: v for k, v in vars(args).items() if k not in\
+		("folder", "force", "device", "jobs", "threads", "stream", "max_memory", "profile", "trace")}
+	for k in ("tokenizer", "plan", "golden_prompts"):
+		if inputs[k] is not None and os.path.exists(inputs[k]):
+			inputs[k] = [inputs[k], file_stats(inputs[k])]
+	return dict(checkpoint=stats, args=inputs)
+
+def up_to_date(folder, inputs):
+	# whether the folder was converted from the same inputs by this version, and no file is missing
+	try:
+		with open(folder/"manifest.json") as f:
+			manifest = json.load(f)
+	except FileNotFoundError:
+		return False
+	return manifest.get("version") == CONVERTER_VERSION and manifest.get("convert") == inputs\
+		and all((folder/x).exists() for entry in manifest["tensors"].values() for x in entry["files"])
+
+def output_folder(args):
+	# a folder ending with a slash gets a subfolder named after the model
+	folder = Path(args.folder)
+	if re.search(r"[/\\]$", args.folder):
+		folder /= Path(args.model).name
+	return folder
+
+def convert_model(args, loaded=None):
+	# loaded is the result of load_model(args), which can be reused for jobs of the same model. returns the output folder
+	from transformers import AutoModelForCausalLM, AutoModelForSeq2SeqLM
+	folder = output_folder(args)
+	print(f"convert: {args.model} => {folder}")
+	global profiler
+	profiler = Profiler() if args.profile or args.trace else None
+	# an unchanged re-run is skipped before loading the model, with a report of the check alone
+	with span("check"):
+		inputs = convert_inputs(args)
+		skip = not args.force and inputs is not None and up_to_date(folder, inputs)
+	if skip:
+		print("up to date")
+		save_profile(args)
+		return folder
+	loaded = loaded or load_model(args)
+	if loaded is None:
+		return None
+	auto_cls, model, tokenizer, checkpoint = loaded
+
+	quantize = (lambda name, shape: np.prod(shape) >= args.quantize*1024*1024) if args.quantize else None
+	plan = None
+	if args.plan:
+		with open(args.plan) as f:
+			plan = json.load(f)["tensors"]
+	evaluate = None
+	if args.plan_logits:
+		model_inputs = testcase_inputs(model, tokenizer, max_positions=args.max_positions)
+		evaluate = lambda: model(**model_inputs).logits
+	print(f"model: {type(model)}")
+	export_lm(model, folder, force_write=bool(args.force), quantize=quantize, jobs=args.jobs, checkpoint=checkpoint,
+		max_memory=int(args.max_memory*1024*1024), codec=args.codec, dedup=args.dedup,
+		max_positions=args.max_positions, plan=plan, error_budget=args.error_budget, evaluate=evaluate,
+		quantize_bits=args.quantize_bits, quantize_group_size=args.group_size, threads=args.threads, atlas=args.atlas)
+	if tokenizer is not None:
+		with span("tokenizer"):
+			export_tokenizer(tokenizer, folder)
+	if checkpoint is not None:
+		print("testcase is skipped in streaming mode")
+	elif auto_cls in [AutoModelForCausalLM, AutoModelForSeq2SeqLM]:
+		with span("testcase"):
+			export_testcase(model, tokenizer, folder, force_write=bool(args.force), max_positions=args.max_positions)
+		if args.golden or args.golden_prompts or args.golden_kv:
+			prompts = GOLDEN_PROMPTS
+			if args.golden_prompts:
+				with open(args.golden_prompts, encoding="utf-8") as f:
+					prompts = [x.rstrip("\r\n").replace("\\n", "\n") for x in f if x.strip()]
+			with span("golden"):
+				export_golden(model, tokenizer, folder, prompts, kv=args.golden_kv, max_positions=args.max_positions)
+	if inputs is not None: # recorded last, so an interrupted run isn't up to date
+		with open(folder/"manifest.json") as f:
+			manifest = json.load(f)
+		with open(folder/"manifest.json.tmp", "w") as f:
+			json.dump(dict(manifest, convert=inputs), f, indent=2)
+		os.replace(folder/"manifest.json.tmp", folder/"manifest.json")
+	save_profile(args)
+	return folder
+
+def save_profile(args):
+	if args.profile:
+		print(args.profile)
+		with open(args.profile, "w") as f:
+			json.dump(profiler.report(), f, indent=2)
+	if args.trace:
+		print(args.trace)
+		with open(args.trace, "w") as f:
+			json.dump(profiler.trace(), f)
+
+def main():
+	args = parse_args()
+	disable_exllama()
+	convert_model(args)
 
 if __name__ == '__main__':
 	with torch.no_grad():
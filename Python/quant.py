@@ -0,0 +1,150 @@
+import math
+import numpy as np
+
+# quantizers of exported weights, shared by convert.py and repack.py. they take numpy arrays, or torch tensors which
+# stay on their device and dtype, so repack.py runs without torch and convert.py quantizes on the device.
+# custom int8 stores a mantissa per weight and an exponent per group of weights, and int4 uses the layout of GPTQ
+
+def array_module(data):
+	if isinstance(data, np.ndarray):
+		return np
+	import torch
+	return torch
+
+def cast(x, dtype):
+	return x.astype(dtype) if isinstance(x, np.ndarray) else x.to(dtype)
+
+def to_numpy(x):
+	return x if isinstance(x, np.ndarray) else x.cpu().numpy()
+
+def pad_end(x, n, axis):
+	# zero padding of n at the end of an axis
+	axis %= x.ndim
+	if isinstance(x, np.ndarray):
+		return np.pad(x, [(0, n if i == axis else 0) for i in range(x.ndim)])
+	import torch.nn.functional as F
+	return F.pad(x, (0,0)*(x.ndim-1-axis) + (0,n))
+
+def permute(x, dims):
+	return x.transpose(dims) if isinstance(x, np.ndarray) else x.permute(dims)
+
+def take_along(x, indices):
+	return np.take_along_axis(x, indices, axis=0) if isinstance(x, np.ndarray) else x.take_along_dim(indices, dim=0)
+
+def column_order(data):
+	# columns by descending l1 norm in the dtype of data, ties in column order
+	if isinstance(data, np.ndarray):
+		return np.argsort(-np.sum(np.abs(data), axis=0), kind="stable")
+	import torch
+	return torch.argsort(torch.linalg.norm(data, ord=1, dim=0), stable=True, descending=True)
+
+def quantize_custom_int8(data, presets, estep, exact):
+	xp = array_module(data)
+	presets = np.array(presets, dtype=data.dtype) if xp is np else xp.tensor(presets, dtype=data.dtype, device=data.device)
+	bmin, bmax, eoff = presets.T[..., None, None, None]
+	with np.errstate(divide="ignore"):
+		expo = xp.clip(xp.ceil(estep*xp.log2(xp.maximum(
+			xp.clip(xp.amin(data, axis=-1, keepdims=True), None, 0)/bmin,
+			xp.clip(xp.amax(data, axis=-1, keepdims=True), 0, None)/bmax))), -42, 42)
+
+	scale = xp.exp2(cast(expo/estep, xp.float32 if exact else data.dtype))
+	mant = xp.clip(data/scale, bmin, bmax)
+	qerr = xp.amax(xp.abs(xp.round(mant*256)/256 * scale - data), axis=-1, keepdims=True)
+	best = xp.argmin(qerr, axis=0, keepdims=True)
+	expo = take_along(expo+eoff, best)[0]
+	mant = take_along(mant, best)[0]
+	qerr = take_along(qerr, best)[0]
+	mant /= 255/256
+	mant += mant < -1/510
+
+	mant = mant.reshape(mant.shape[0], -1)
+	expo = permute(pad_end(expo, -expo.shape[-3] % 4, -3).reshape(-1, 4, expo.shape[1]), (0,2,1))
+	expo = expo.reshape(expo.shape[0], -1)
+	return mant, expo, qerr
+
+def quantize_custom_int4(data, ratios=(1.0, 0.95, 0.9, 0.85, 0.8, 0.75)):
+	# asymmetric 4-bit groups in the layout of 4-bit GPTQ: weight == (weight_u4 - zero_u4) * scale.
+	# the range of each group is shrunk by the ratio of least squared error, like the mse option of GPTQ
+	xp = array_module(data)
+	data = cast(data, xp.float32)
+	xmin = xp.clip(xp.amin(data, axis=-1, keepdims=True), None, 0)
+	xmax = xp.clip(xp.amax(data, axis=-1, keepdims=True), 0, None)
+	best = None
+	for ratio in ratios:
+		# round the scale to 24 bits first, so that weights are rounded with the scale that the shader sees
+		scale = xp.clip(cast(xp.where(xmax > xmin, (xmax-xmin)*ratio/15, 1), xp.float32) / 17 * 256, xp.finfo(xp.float32).tiny, None)
+		scale = (scale.view(xp.int32) & -256).view(xp.float32)
+		zero = xp.clip(xp.round(-xmin*ratio / (scale*17/256)), 0, 15)
+		weight = xp.clip(xp.round(data / (scale*17/256)) + zero, 0, 15)
+		err = xp.sum(xp.square((weight-zero) * (scale*17/256) - data), axis=-1, keepdims=True)
+		if best is None:
+			best = [err, weight, zero, scale]
+		else:
+			better = err < best[0]
+			best = [xp.where(better, x, y) for x, y in zip([err, weight, zero, scale], best)]
+	_, weight, zero, scale = best
+	weight = cast(weight*17, xp.uint8).reshape(weight.shape[0], -1)
+	scale = (scale.view(xp.int32) | cast(zero*17, xp.int32)).view(xp.float32)[..., 0]
+	return weight, scale
+
+def int8_quantizer(asym, estep, exact):
+	presets = [(-127/256, +127/256, 0)] + ([(-63/256, +191/256, +85), (-191/256, +63/256, -85)] if asym else [])
+	return lambda x: quantize_custom_int8(x, presets, estep, exact)
+
+def quantize_blocks(data, group_size, act_order, max_memory, quantize):
+	# returns padded data, column order, and an iterator of (row, block size, quantize result of the block)
+	if data.shape[-1] % group_size:
+		data = pad_end(data, -data.shape[-1] % group_size, -1) # must pad before sorting
+	indices = column_order(data) if act_order else None
+
+	# quantize blocks of rows to bound the size of temporaries. rows are independent, and a multiple of 64 rows
+	# keeps vectorized math aligned as if the whole tensor were processed at once
+	itemsize = data.itemsize if isinstance(data, np.ndarray) else data.element_size()
+	block = max(1, max_memory // (16 * data.shape[1] * itemsize) // 64) * 64 if max_memory else data.shape[0]
+	def blocks():
+		for i in range(0, data.shape[0], block):
+			x = data[i:i+block] if indices is None else data[i:i+block, indices]
+			x = x.reshape(x.shape[0], -1, group_size)
+			yield i, block, quantize(x)
+	return data, indices, blocks()
+
+def column_indices(indices):
+	# the column order and its inverse, in float for int indices
+	xp = array_module(indices)
+	return to_numpy(cast(xp.stack((indices, xp.argsort(indices))), xp.float32))
+
+def export_custom_int8(data, asym=True, group_size=4, *, estep=2, exact=False, act_order=True, max_memory=256<<20):
+	data, indices, blocks = quantize_blocks(data, group_size, act_order, max_memory, int8_quantizer(asym, estep, exact))
+	xp = array_module(data)
+	mant = xp.empty(data.shape, dtype=data.dtype)
+	expo = xp.empty(((data.shape[0]+3)//4, data.shape[1]//group_size*4), dtype=data.dtype)
+	for i, block, (m, e, _) in blocks:
+		mant[i:i+block], expo[i//4:(i+block+3)//4] = m, e
+
+	if indices is not None:
+		indices = column_indices(indices)
+	return to_numpy(mant), to_numpy(expo).astype(np.int8).astype(np.uint8), indices
+
+def export_custom_int4(data, group_size=32, *, act_order=True, max_memory=256<<20):
+	# returns (weight, scales, indices) like export_gptq
+	data, indices, blocks = quantize_blocks(data, group_size, act_order, max_memory, quantize_custom_int4)
+	xp = array_module(data)
+	weight = xp.empty(data.shape, dtype=xp.uint8)
+	scales = xp.zeros(((data.shape[0]+3)//4*4, data.shape[1]//group_size), dtype=xp.float32)
+	for i, block, (w, s) in blocks:
+		weight[i:i+block], scales[i:i+block] = w, s
+	scales = permute(scales.reshape(-1, 4, scales.shape[1]), (0,2,1)).reshape(scales.shape[0]//4, -1)
+
+	if indices is not None:
+		indices = column_indices(indices)
+	return to_numpy(weight), to_numpy(scales), indices
+
+def export_quantized(data, bits=8, **kwargs):
+	return export_custom_int4(data, **kwargs) if bits == 4 else export_custom_int8(data, **kwargs)
+
+def custom_int8_error(data, asym=True, group_size=4, *, estep=2, exact=False, act_order=True, max_memory=256<<20):
+	# rms of qerr, the max abs error of each group, without keeping the quantized tensor
+	data, _, blocks = quantize_blocks(data, group_size, act_order, max_memory, int8_quantizer(asym, estep, exact))
+	xp = array_module(data)
+	total = sum(float(xp.sum(xp.square(cast(qerr, xp.float64)))) for _, _, (_, _, qerr) in blocks)
+	return math.sqrt(total / (data.shape[0] * (data.shape[1]//group_size)))
@@ -0,0 +1,214 @@
+import os
+import re
+import math
+import json
+import time
+import shutil
+import struct
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from texture import MAX_SIZE, CODEC_POLICIES, imwrite, select_codec, pad_tile, can_quantize
+from quant import export_quantized
+import runtime
+
+# re-pack an exported model folder with numpy and cv2 only: textures are decoded into logical tensors with the shapes
+# in manifest.json, and written again with another tiling, quantization or codec. files are re-packed by a thread pool,
+# since cv2 and numpy release the GIL
+
+def exr_is_half(path):
+	# pixel type of the exr channels, like IsHalfExr in ModelImporter.cs
+	with open(path, "rb") as f:
+		magic, _ = struct.unpack("<ii", f.read(8))
+		if magic != 20000630:
+			return False
+		def read_string():
+			return b"".join(iter(lambda: f.read(1), b"\0")).decode()
+		while name := read_string():
+			type = read_string()
+			size, = struct.unpack("<i", f.read(4))
+			if type != "chlist":
+				f.seek(size, os.SEEK_CUR)
+				continue
+			read_string()
+			return struct.unpack("<i", f.read(4))[0] == 1 # pixel type: 0 uint, 1 half, 2 float
+	return False
+
+def quantized_files(name, bits):
+	if bits == 4:
+		return [f"{name}.png", f"{name}.q8.exr", f"{name}.q8.idx.exr"]
+	return [f"{name}.exr", f"{name}.q8.png", f"{name}.q8.idx.exr"]
+
+def file_size0(entry, suffix):
+	# rows of a file before tiling, like FixSize0 in Module.cs
+	size0 = 1 if len(entry["shape"]) == 1 else entry["shape"][0]
+	return 2 if suffix == ".q8.idx" else (size0+3)//4 if suffix == ".q8" else size0
+
+def file_width(entry, suffix):
+	# texels in a row of a file before padding for tiling, or None if it is only known from an untiled file
+	shape, format = entry["shape"], entry["format"]
+	if format == "float":
+		if len(shape) == 1:
+			return -(-shape[0]//4)
+		return shape[1] * -(-shape[2]//4) if len(shape) == 3 and shape[2] != 1 else -(-shape[1]//4)
+	if format == "gptq":
+		return None if suffix == ".q8" else -(-shape[1]//4)
+	group_size = entry.get("group_size", 4)
+	cols = -(-shape[1]//group_size)*group_size
+	return cols//group_size if suffix == ".q8" else cols//4
+
+def read_texture(path, size0, width=None):
+	# inverse of pad_tile, returning a (size0, width*4) matrix
+	data = runtime.imread(path)
+	assert width is not None or data.shape[0] == size0, f"{path.name} is tiled, but its width is unknown"
+	data = runtime.untile(data, size0)
+	return data if width is None else data[:, :width*4]
+
+def write_texture(path, data, max_size, codec=None):
+	# returns the codec report entry, or None without codec
+	data = pad_tile(data, max_size)
+	if data.shape[0] > MAX_SIZE:
+		print(f"\t\t{path.name} is {data.shape[0]} texels high after tiling, more than {MAX_SIZE}")
+	if codec is not None:
+		return select_codec(path, data, codec)
+	imwrite(path, data)
+	return None
+
+def repack_file(src, dst, size0, width, max_size, codec=None):
+	# same tensor format: the file is only re-tiled and re-encoded, which is lossless
+	data = read_texture(src, size0, width)
+	if src.suffix == ".exr" and exr_is_half(src):
+		data = data.astype(np.float16)
+	return [write_texture(dst, data, max_size, codec)]
+
+def repack_tensor(state_dict, folder, name, entry, max_size, codec=None, max_memory=256<<20):
+	# new tensor format: the tensor is dequantized to float, and quantized again if entry is int8 or int4
+	data = state_dict.load(name).astype(np.float16 if entry["dtype"] == "torch.float16" else np.float32)
+	if entry["format"] == "float":
+		arrays = (data,)
+	else:
+		arrays = export_quantized(data, bits=int(entry["format"][3:]), group_size=entry.get("group_size", 4),
+			max_memory=max_memory)
+	return [write_texture(folder/filename, array, max_size, codec)
+		for filename, array in zip(entry["files"], arrays) if array is not None]
+
+def repack(folder, out=None, max_size=MAX_SIZE, quantize=None, quantize_bits=8, quantize_group_size=None,
+		dequantize=False, codec=None, jobs=1, max_memory=256<<20):
+	folder = Path(folder)
+	out = Path(out) if out else folder
+	group_size = quantize_group_size or (4 if quantize_bits == 8 else 32)
+	assert group_size % 4 == 0, f"group size {group_size} should be a multiple of 4"
+	# shapes and formats are only known from the manifest, which folders of older versions of convert.py don't have
+	if not (folder/"manifest.json").exists():
+		raise FileNotFoundError(f"{folder/'manifest.json'} is not found. re-export the folder with the current convert.py")
+	with open(folder/"manifest.json") as f:
+		manifest = json.load(f)
+	with open(folder/"config.json") as f:
+		atlas = json.load(f).get("atlas", [])
+	atlas_files = {} # atlas file => texels, the atlas is re-packed as it is
+	for x in atlas:
+		atlas_files[f"{x['texture']}.exr"] = max(atlas_files.get(f"{x['texture']}.exr", 0), -(-(x["offset"]+x["size"])//4))
+	old_files = [x for entry in manifest["tensors"].values() for x in entry["files"]] + list(atlas_files)
+	old_size = sum(os.path.getsize(folder/x) for x in old_files)
+
+	# new format of each tensor. quantized tensors are only quantized again after dequantize
+	tensors = {}
+	for name, entry in manifest["tensors"].items():
+		new = {k: v for k, v in entry.items() if k != "codec"}
+		if dequantize and entry["format"] != "float":
+			new.update(format="float", files=[f"{name}.exr"])
+			new.pop("group_size", None)
+		if new["format"] == "float" and quantize is not None and can_quantize(name, new["shape"])\
+			and quantize(name, new["shape"]):
+			new.update(format=f"int{quantize_bits}", files=quantized_files(name, quantize_bits))
+			if group_size != 4:
+				new["group_size"] = group_size
+		if codec is not None:
+			new["codec"] = codec
+		tensors[name] = new
+	for name, new in tensors.items():
+		if "alias" in new: # aliases share the format of their target
+			new.update({k: tensors[new["alias"]][k] for k in ("format", "group_size") if k in tensors[new["alias"]]})
+			new["files"] = []
+
+	os.makedirs(out, exist_ok=True)
+	if out != folder:
+		for x in folder.iterdir():
+			if x.is_file() and x.suffix not in (".exr", ".png", ".meta") and x.name not in ("manifest.json", "codec_report.json"):
+				shutil.copy2(x, out/x.name)
+
+	start = time.perf_counter()
+	state_dict = runtime.StateDict(folder)
+	futures = []
+	with ThreadPoolExecutor(jobs) as pool:
+		for name, entry in manifest["tensors"].items():
+			new = tensors[name]
+			if "alias" in new:
+				continue
+			print(f"\t{name}\t{tuple(new['shape'])} {entry['format']}" +
+				(f" => {new['format']}" if new["format"] != entry["format"] else ""))
+			if new["format"] != entry["format"]:
+				futures.append(pool.submit(repack_tensor, state_dict, out, name, new, max_size, codec, max_memory))
+				continue
+			for filename in entry["files"]:
+				suffix = re.search(r"([.]q8([.]idx)?)?[.](exr|png)$", filename)[1] or ""
+				futures.append(pool.submit(repack_file, folder/filename, out/filename,
+					file_size0(entry, suffix), file_width(entry, suffix), max_size, codec))
+		for filename, width in atlas_files.items():
+			print(f"\t{filename[:-4]}")
+			futures.append(pool.submit(repack_file, folder/filename, out/filename, 1, width, max_size, codec))
+		report = [x for future in futures for x in future.result() if x is not None]
+
+	new_files = [x for new in tensors.values() for x in new["files"]] + list(atlas_files)
+	if out == folder: # files of old formats
+		for x in set(old_files) - set(new_files):
+			(folder/x).unlink(missing_ok=True)
+	new_size = sum(os.path.getsize(out/x) for x in new_files)
+	formats = {x: sum(new["format"] == x for new in tensors.values()) for x in sorted({new["format"] for new in tensors.values()})}
+	print(f"repack: {len(futures)} tasks, {old_size/2**20:.1f}MiB => {new_size/2**20:.1f}MiB"
+		f" in {time.perf_counter()-start:.1f}s, {formats}")
+
+	if codec is not None:
+		report.sort(key=lambda x: x["file"])
+		total_size = sum(x["size"] for x in report)
+		counts = {x: sum(y["codec"] == x for y in report) for x in sorted({y["codec"] for y in report})}
+		print(f"codec: {codec} {len(report)} files, {total_size/2**20:.1f}MiB, {counts}")
+		with open(out/"codec_report.json", "w") as f:
+			json.dump(dict(policy=codec, size=total_size, files=report), f, indent=2)
+	else:
+		(out/"codec_report.json").unlink(missing_ok=True)
+
+	manifest.pop("convert", None) # the folder is no longer what convert.py made from its arguments
+	with open(out/"manifest.json.tmp", "w") as f:
+		json.dump(dict(manifest, tensors=tensors), f, indent=2)
+	os.replace(out/"manifest.json.tmp", out/"manifest.json")
+	return out
+
+def main():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('folder', help='exported model folder with manifest.json. for example: ../Model/TinyStories-1M')
+	parser.add_argument('--out', type=str, help='output folder. default: re-pack in place')
+	parser.add_argument('--max-size', type=int, default=MAX_SIZE, help='max texture width, wider tensors are tiled.'
+		' for example 4096 for GPUs with smaller textures')
+	parser.add_argument('--quantize', type=float, help='quantize float weights of at least this many Mi elements')
+	parser.add_argument('--quantize-bits', type=int, choices=[8, 4], default=8, help='8 for custom int8, 4 for 4-bit groups like GPTQ')
+	parser.add_argument('--group-size', type=int, help='number of weights sharing a scale in --quantize, a multiple of 4. default: 4 for 8 bits, 32 for 4 bits')
+	parser.add_argument('--dequantize', action='store_true', help='convert quantized weights to float, before --quantize if both are given')
+	parser.add_argument('--codec', choices=CODEC_POLICIES, help='choose lossless codec per texture by size and decode speed')
+	parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='number of threads re-packing files')
+	parser.add_argument('--max-memory', type=float, default=256, help='memory budget in MiB for quantizing a tensor')
+	args = parser.parse_args()
+	if not 1 <= args.max_size <= MAX_SIZE:
+		parser.error(f"--max-size should be between 1 and {MAX_SIZE}")
+	if not (Path(args.folder)/"manifest.json").exists():
+		parser.error(f"{Path(args.folder)/'manifest.json'} is not found. re-export the folder with the current convert.py")
+
+	quantize = (lambda name, shape: math.prod(shape) >= args.quantize*1024*1024) if args.quantize else None
+	folder = repack(args.folder, args.out, max_size=args.max_size, quantize=quantize, quantize_bits=args.quantize_bits,
+		quantize_group_size=args.group_size, dequantize=args.dequantize, codec=args.codec, jobs=args.jobs,
+		max_memory=int(args.max_memory*1024*1024))
+	print(folder)
+
+if __name__ == '__main__':
+	main()
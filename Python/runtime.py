@@ -0,0 +1,504 @@
+import os
+os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
+
+import re
+import math
+import json
+import time
+import numpy as np
+import cv2
+from pathlib import Path
+
+def imread(path):
+	data = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+	if data is None:
+		raise FileNotFoundError(path)
+	return data[::-1, :, [2,1,0,3]] # flip Y and BGRA to RGBA
+
+def untile(data, size0):
+	# inverse of wide texture tiling in export_tensor, returning a (size0, -1) matrix
+	tile = data.shape[0] // size0
+	assert data.shape[0] == size0 * tile and tile & (tile-1) == 0, f"{data.shape} is not a tiling of {size0} rows"
+	return data.reshape(size0, tile, data.shape[1], 4).transpose(0, 2, 1, 3).reshape(size0, -1)
+
+def unpad(data, shape):
+	# inverse of padding in export_tensor
+	if len(shape) == 1:
+		return data.reshape(-1)[:shape[0]]
+	elif len(shape) == 2:
+		return data[:, :shape[1]]
+	elif shape[-1] == 1:
+		return data[:, :shape[1], None]
+	else:
+		size2 = -(-shape[2]//4)*4
+		return data[:, :shape[1]*size2].reshape(shape[0], shape[1], size2)[..., :shape[2]]
+
+def unpack_quant(data, size0):
+	# inverse of packing 4 rows of scales into RGBA
+	data = data.reshape(data.shape[0], -1, 4).transpose(0, 2, 1)
+	return data.reshape(-1, data.shape[2])[:size0]
+
+def group_index(weight, quant):
+	# each quant column covers the same number of weight columns, like S in Gather.shader
+	group = max(1, weight.shape[1] // quant.shape[1])
+	return np.minimum(np.arange(weight.shape[1]) // group, quant.shape[1]-1)
+
+def dequantize_custom_int8(mant, expo, estep=2):
+	# same as dequantizeWeight & dequantizeScale with WEIGHT_QUANTIZED_E8
+	expo = unpack_quant(expo.view(np.int8).astype(np.float32), mant.shape[0])
+	etype = np.rint(expo/85)
+	scale = np.exp2((expo - etype*85)/estep - 8)
+	offset = etype*0.25 + 0.5
+	g = group_index(mant, expo)
+	return (np.rint(mant*255) - np.where(mant > offset[:, g], 255, 0)) * scale[:, g]
+
+def dequantize_gptq(weight, scales):
+	# same as dequantizeWeight & dequantizeScale with WEIGHT_QUANTIZED_S24_Z8
+	u32 = unpack_quant(np.ascontiguousarray(scales, dtype=np.float32).view(np.uint32), weight.shape[0])
+	zeros = (u32 & 0xFF).astype(np.float32)
+	scales = (u32 & np.uint32(0xFFFFFF00)).view(np.float32) / 256
+	g = group_index(weight, scales)
+	return (weight.astype(np.float32) - zeros[:, g]) * scales[:, g]
+
+class StateDict:
+	def __init__(self, folder):
+		self.folder = Path(folder)
+		try:
+			with open(self.folder/"manifest.json") as f:
+				self.shapes = {k: v["shape"] for k, v in json.load(f)["tensors"].items()}
+		except FileNotFoundError: # exported before manifest.json, shapes are inferred from textures
+			self.shapes = {}
+		try:
+			with open(self.folder/"aliases.json") as f:
+				self.aliases = {x["name"]: x["target"] for x in json.load(f)["aliases"]}
+		except FileNotFoundError:
+			self.aliases = {}
+		try:
+			with open(self.folder/"config.json") as f:
+				self.atlas = {x["name"]: x for x in json.load(f).get("atlas", [])}
+		except FileNotFoundError:
+			self.atlas = {}
+		self.atlas_textures = {} # atlas texture => decoded row
+		self.names = {re.sub(r"([.]q8([.]idx)?)?[.](exr|png)$", "", x.name)
+			for x in self.folder.iterdir() if re.search(r"[.](exr|png)$", x.name)} | set(self.aliases) | set(self.atlas)
+
+	def __contains__(self, name):
+		return name in self.names
+
+	def load(self, name, size0=None):
+		# size0 is only needed for tiled textures without manifest, like FixSize0 in Module.cs
+		shape = self.shapes.get(name)
+		if name in self.atlas: # small tensors packed in an atlas texture
+			x = self.atlas[name]
+			if x["texture"] not in self.atlas_textures:
+				self.atlas_textures[x["texture"]] = untile(imread(self.folder/f"{x['texture']}.exr"), 1)[0]
+			return self.atlas_textures[x["texture"]][x["offset"]:x["offset"]+x["size"]].astype(np.float32)
+		name = self.aliases.get(name, name) # identical tensors share textures
+		path = self.folder/name
+		if shape is not None:
+			size0 = 1 if len(shape) == 1 else shape[0]
+		if Path(f"{path}.q8.png").exists():
+			data = imread(f"{path}.exr")
+			size0 = size0 or data.shape[0]
+			data = dequantize_custom_int8(untile(data, size0), untile(imread(f"{path}.q8.png"), (size0+3)//4))
+		elif Path(f"{path}.q8.exr").exists():
+			data = imread(f"{path}.png")
+			size0 = size0 or data.shape[0]
+			data = dequantize_gptq(untile(data, size0), untile(imread(f"{path}.q8.exr"), (size0+3)//4))
+		else:
+			data = imread(f"{path}.exr")
+			size0 = size0 or data.shape[0]
+			data = untile(data, size0)
+		if Path(f"{path}.q8.idx.exr").exists(): # undo act-order
+			data = data[:, untile(imread(f"{path}.q8.idx.exr"), 2)[1].astype(np.int64)]
+		if shape is None:
+			shape = (data.shape[1],) if size0 == 1 else data.shape
+		return unpad(data, shape).astype(np.float32)
+
+def erf(x):
+	# cuda erff, same as Common.hlsl
+	p = np.abs(x) >= +1.00295997e+00
+	t = np.where(p, np.abs(x), x * x)
+	r = np.where(p, +1.12198715e-04, +8.48349446e-05)
+	for a, b in [(-1.32752524e-03, -8.21309164e-04), (+8.39653518e-03, +5.21348882e-03),
+			(-4.02465835e-02, -2.68687736e-02), (+1.59504309e-01, +1.12840049e-01),
+			(+9.12917674e-01, -3.76126647e-01), (+6.29060030e-01, +1.28379151e-01)]:
+		r = r * t + np.where(p, a, b)
+	t = np.where(p, -np.abs(x), x)
+	r = r * t + t
+	return np.where(p, np.sign(x) * (1 - np.exp2(r)), r).astype(x.dtype)
+
+ACT2FN = {
+	"gelu": lambda x: x * (0.5 + 0.5 * erf(x * 0.7071067811865475)),
+	"gelu_new": lambda x: 0.5 * x * (1 + np.tanh(0.7978845608028654 * (x + 0.044715 * x*x*x))),
+	"gelu_pytorch_tanh": lambda x: ACT2FN["gelu_new"](x),
+	"relu": lambda x: np.maximum(x, 0),
+	"silu": lambda x: x / (1 + np.exp(-x)),
+	"swish": lambda x: ACT2FN["silu"](x),
+}
+
+class ModelForCausalLM:
+	def __init__(self, state_dict, config):
+		self.state_dict = state_dict
+		self.config = config
+		self.params = {}
+		self.cache = {}
+		self.position = 0
+		self.recorded = None # list of hidden states of each layer when recording
+
+	def __call__(self, input_ids):
+		# input_ids: (batch, seq) continuing from the cached tokens
+		input_ids = np.asarray(input_ids).reshape(-1, np.shape(input_ids)[-1])
+		position_ids = self.position + np.arange(input_ids.shape[1])
+		if self.position + input_ids.shape[1] > self.config.get("max_positions", math.inf):
+			raise ValueError(f"position {position_ids[-1]} exceeds max_positions {self.config['max_positions']} of exported tables")
+		logits, hidden_states = self.ForCausalLM(input_ids, position_ids)
+		self.position += input_ids.shape[1]
+		return logits[..., :self.config["vocab_size"]], hidden_states
+
+	def CacheClear(self):
+		self.cache.clear()
+		self.position = 0
+
+	def generate(self, input_ids, max_new_tokens):
+		# greedy search
+		tokens = []
+		logits, _ = self(input_ids)
+		for i in range(max_new_tokens):
+			tokens.append(np.argmax(logits[:, -1], axis=-1))
+			if i+1 < max_new_tokens:
+				logits, _ = self(tokens[-1][:, None])
+		return np.stack(tokens, axis=1)
+
+	# utilities
+	def param(self, name, size0=None):
+		if name not in self.params:
+			self.params[name] = self.state_dict.load(name, size0=size0)
+		return self.params[name]
+	def FixSize0(self, name, size0):
+		if name in self.state_dict:
+			self.param(name, size0=size0)
+	def Record(self, hidden_states, scale=1.0):
+		# hidden states of each layer like output_hidden_states in transformers
+		if self.recorded is not None:
+			self.recorded.append(hidden_states * scale)
+		return hidden_states
+	def CacheUpdate(self, path, x):
+		# x: (batch, heads, seq, head_dim)
+		if path in self.cache:
+			x = np.concatenate((self.cache[path], x), axis=2)
+		self.cache[path] = x
+		return x
+
+	# common layers
+	def Embedding(self, path, input_ids, fallback=None):
+		if fallback is not None and f"{path}.weight.T" not in self.state_dict and f"{path}.weight" not in self.state_dict:
+			path = fallback
+		if f"{path}.weight.T" in self.state_dict:
+			return self.param(f"{path}.weight.T")[:, input_ids].transpose(*range(1, input_ids.ndim+1), 0)
+		return self.param(f"{path}.weight")[input_ids]
+	def Linear(self, path, x, fallback=None):
+		if fallback is not None and f"{path}.weight.T" not in self.state_dict and f"{path}.weight" not in self.state_dict:
+			path = fallback
+		if f"{path}.weight.T" in self.state_dict:
+			x = x @ self.param(f"{path}.weight.T")
+		else:
+			x = x @ self.param(f"{path}.weight").T
+		if f"{path}.bias" in self.state_dict:
+			x += self.param(f"{path}.bias")
+		return x
+	def LayerNorm(self, path, x, eps, rms=False):
+		if not rms:
+			x = x - x.mean(axis=-1, keepdims=True)
+		x = x / np.sqrt(np.mean(x*x, axis=-1, keepdims=True) + eps) * self.param(f"{path}.weight")
+		if f"{path}.bias" in self.state_dict:
+			x += self.param(f"{path}.bias")
+		return x
+	def Rotary(self, x, rotary, heads):
+		# rotary: (seq, dim) as padded complex numbers (cos, sin), see RotaryEmbedding in export_lm
+		x = x.reshape(*x.shape[:-1], heads, -1)
+		half = rotary.shape[-1]//2
+		cos, sin = rotary[:, None, :half], rotary[:, None, half:]
+		x1, x2 = x[..., :half], x[..., half:2*half]
+		x = np.concatenate((x1*cos - x2*sin, x2*cos + x1*sin, x[..., 2*half:]), axis=-1)
+		return x.reshape(*x.shape[:-2], -1)
+	def Attention(self, path, q, k, v, position_ids, heads, kv_heads=None, scale=1.0, window_size=None):
+		# scaled dot-product attention over the kv cache with a causal sliding window
+		kv_heads = kv_heads or heads
+		batch, seq = q.shape[:2]
+		q = q.reshape(batch, seq, heads, -1).transpose(0, 2, 1, 3)
+		k = self.CacheUpdate(f"{path}.k", k.reshape(batch, seq, kv_heads, -1).transpose(0, 2, 1, 3))
+		v = self.CacheUpdate(f"{path}.v", v.reshape(batch, seq, kv_heads, -1).transpose(0, 2, 1, 3))
+		q = q.reshape(batch, kv_heads, -1, q.shape[-1]) # group query heads sharing a kv head
+		scores = (q @ k.transpose(0, 1, 3, 2)).reshape(batch, heads, seq, -1) * scale
+
+		key_ids = np.arange(k.shape[2])
+		mask = key_ids <= position_ids[:, None]
+		if window_size is not None:
+			mask &= key_ids > position_ids[:, None] - window_size
+		scores = np.where(mask, scores, -np.inf)
+		scores = np.exp(scores - scores.max(axis=-1, keepdims=True))
+		scores /= scores.sum(axis=-1, keepdims=True)
+
+		x = scores.reshape(batch, kv_heads, -1, k.shape[2]) @ v
+		return x.reshape(batch, heads, seq, -1).transpose(0, 2, 1, 3).reshape(batch, seq, -1)
+
+class GPT2(ModelForCausalLM):
+	def GPT2Attention(self, path, hidden_states, position_ids):
+		hidden_size = self.config["n_embd"]
+		qkv = self.Linear(f"{path}.c_attn", hidden_states)
+		q, k, v = qkv[..., :hidden_size], qkv[..., hidden_size:2*hidden_size], qkv[..., 2*hidden_size:]
+		hidden_states = self.Attention(path, q, k, v, position_ids, self.config["n_head"],
+			scale=(hidden_size / self.config["n_head"])**-0.5)
+		return self.Linear(f"{path}.c_proj", hidden_states)
+	def GPT2MLP(self, path, hidden_states):
+		hidden_states = self.Linear(f"{path}.c_fc", hidden_states)
+		hidden_states = ACT2FN[self.config["activation_function"]](hidden_states)
+		return self.Linear(f"{path}.c_proj", hidden_states)
+	def GPT2Block(self, path, hidden_states, position_ids):
+		eps = self.config["layer_norm_epsilon"]
+		hidden_states = hidden_states + self.GPT2Attention(f"{path}.attn",
+			self.LayerNorm(f"{path}.ln_1", hidden_states, eps), position_ids)
+		hidden_states = hidden_states + self.GPT2MLP(f"{path}.mlp", self.LayerNorm(f"{path}.ln_2", hidden_states, eps))
+		return hidden_states
+	def GPT2Model(self, path, input_ids, position_ids):
+		hidden_states = self.Embedding(f"{path}.wte", input_ids) + self.Embedding(f"{path}.wpe", position_ids)
+		for i in range(self.config["n_layer"]):
+			self.Record(hidden_states)
+			hidden_states = self.GPT2Block(f"{path}.h.{i}", hidden_states, position_ids)
+		return self.Record(self.LayerNorm(f"{path}.ln_f", hidden_states, self.config["layer_norm_epsilon"]))
+	def ForCausalLM(self, input_ids, position_ids):
+		hidden_states = self.GPT2Model("transformer", input_ids, position_ids)
+		logits = self.Linear("lm_head", hidden_states, fallback="transformer.wte")
+		return logits, hidden_states
+
+class GPTNeo(ModelForCausalLM):
+	def GPTNeoSelfAttention(self, path, hidden_states, position_ids, layer_id):
+		q = self.Linear(f"{path}.q_proj", hidden_states)
+		k = self.Linear(f"{path}.k_proj", hidden_states)
+		v = self.Linear(f"{path}.v_proj", hidden_states)
+		window_size = self.config["window_size"] if self.config["attention_layers"][layer_id] == "local" else None
+		hidden_states = self.Attention(path, q, k, v, position_ids, self.config["num_heads"], window_size=window_size)
+		return self.Linear(f"{path}.out_proj", hidden_states)
+	def GPTNeoMLP(self, path, hidden_states):
+		hidden_states = self.Linear(f"{path}.c_fc", hidden_states)
+		hidden_states = ACT2FN[self.config["activation_function"]](hidden_states)
+		return self.Linear(f"{path}.c_proj", hidden_states)
+	def GPTNeoBlock(self, path, hidden_states, position_ids, layer_id):
+		eps = self.config["layer_norm_epsilon"]
+		hidden_states = hidden_states + self.GPTNeoSelfAttention(f"{path}.attn.attention",
+			self.LayerNorm(f"{path}.ln_1", hidden_states, eps), position_ids, layer_id)
+		hidden_states = hidden_states + self.GPTNeoMLP(f"{path}.mlp", self.LayerNorm(f"{path}.ln_2", hidden_states, eps))
+		return hidden_states
+	def GPTNeoModel(self, path, input_ids, position_ids):
+		hidden_states = self.Embedding(f"{path}.wte", input_ids) + self.Embedding(f"{path}.wpe", position_ids)
+		for i in range(self.config["num_layers"]):
+			self.Record(hidden_states)
+			hidden_states = self.GPTNeoBlock(f"{path}.h.{i}", hidden_states, position_ids, i)
+		return self.Record(self.LayerNorm(f"{path}.ln_f", hidden_states, self.config["layer_norm_epsilon"]))
+	def ForCausalLM(self, input_ids, position_ids):
+		hidden_states = self.GPTNeoModel("transformer", input_ids, position_ids)
+		logits = self.Linear("lm_head", hidden_states, fallback="transformer.wte")
+		return logits, hidden_states
+
+class Llama(ModelForCausalLM):
+	@property
+	def hidden_act(self):
+		if self.config["model_type"] == "gemma":
+			return self.config.get("hidden_activation") or "gelu_pytorch_tanh"
+		return self.config["hidden_act"]
+	@property
+	def rms(self):
+		return not self.config.get("layer_norm_eps")
+
+	def LlamaAttention(self, path, hidden_states, position_ids):
+		heads = self.config["num_attention_heads"]
+		kv_heads = self.config.get("num_key_value_heads") or heads
+		if f"{path}.qkv_proj.weight" in self.state_dict:
+			qkv = self.Linear(f"{path}.qkv_proj", hidden_states)
+			kv_size = qkv.shape[-1] // (heads + 2*kv_heads) * kv_heads
+			q, k, v = qkv[..., :-2*kv_size], qkv[..., -2*kv_size:-kv_size], qkv[..., -kv_size:]
+		else:
+			q = self.Linear(f"{path}.q_proj", hidden_states)
+			k = self.Linear(f"{path}.k_proj", hidden_states)
+			v = self.Linear(f"{path}.v_proj", hidden_states)
+
+		rotary = self.Embedding(f"{path}.rotary_emb", position_ids, fallback=re.sub(r"[.]\d+[.]", ".0.", f"{path}.rotary_emb"))
+		q = self.Rotary(q, rotary, heads)
+		k = self.Rotary(k, rotary, kv_heads)
+
+		head_dim = self.config.get("head_dim") or self.config["hidden_size"] // heads
+		hidden_states = self.Attention(path, q, k, v, position_ids, heads, kv_heads,
+			scale=head_dim**-0.5, window_size=self.config.get("sliding_window"))
+		return self.Linear(f"{path}.o_proj", hidden_states)
+	def LlamaMLP(self, path, hidden_states):
+		if f"{path}.gate_up_proj.weight" in self.state_dict:
+			gate, up = np.split(self.Linear(f"{path}.gate_up_proj", hidden_states), 2, axis=-1)
+		else:
+			gate = self.Linear(f"{path}.gate_proj", hidden_states)
+			up   = self.Linear(f"{path}.up_proj",   hidden_states)
+		return self.Linear(f"{path}.down_proj", ACT2FN[self.hidden_act](gate) * up)
+	def LlamaDecoderLayer(self, path, hidden_states, position_ids, scale=1.0):
+		eps = self.config.get("layer_norm_eps") or self.config["rms_norm_eps"]
+		attn_states = self.LlamaAttention(f"{path}.self_attn",
+			self.LayerNorm(f"{path}.input_layernorm", hidden_states, eps, rms=self.rms), position_ids)
+		hidden_states = hidden_states * scale + attn_states
+		hidden_states = hidden_states + self.LlamaMLP(f"{path}.mlp",
+			self.LayerNorm(f"{path}.post_attention_layernorm", hidden_states, eps, rms=self.rms))
+		return hidden_states
+	def LlamaModel(self, path, input_ids, position_ids):
+		self.FixSize0(f"{path}.embed_tokens.weight.T", self.config["hidden_size"])
+		hidden_states = self.Embedding(f"{path}.embed_tokens", input_ids)
+		for i in range(self.config["num_hidden_layers"]):
+			scale = self.config["hidden_size"]**0.5 if i == 0 and self.config["model_type"] == "gemma" else 1.0
+			self.Record(hidden_states, scale)
+			hidden_states = self.LlamaDecoderLayer(f"{path}.layers.{i}", hidden_states, position_ids, scale=scale)
+		return self.Record(self.LayerNorm(f"{path}.norm", hidden_states,
+			self.config.get("layer_norm_eps") or self.config["rms_norm_eps"], rms=self.rms))
+	def ForCausalLM(self, input_ids, position_ids):
+		self.FixSize0("lm_head.weight.T", self.config["hidden_size"])
+		hidden_states = self.LlamaModel("model", input_ids, position_ids)
+		logits = self.Linear("lm_head", hidden_states, fallback="model.embed_tokens")
+		return logits, hidden_states
+
+def from_pretrained(folder):
+	with open(Path(folder)/"config.json") as f:
+		config = json.load(f)
+	model_type = config["model_type"]
+	if model_type == "gpt2":
+		model_cls = GPT2
+	elif model_type == "gpt_neo":
+		model_cls = GPTNeo
+	elif model_type in ["gemma", "llama", "mistral", "qwen2", "stablelm", "phi3"]:
+		model_cls = Llama
+	else:
+		raise NotImplementedError(f"{model_type=}")
+	return model_cls(StateDict(folder), config)
+
+# max error of (hidden_states, logits), same as BasicLM.cs
+testErrMap = {
+	"gpt2":     (8e-5, 2e-4),
+	"gpt_neo":  (5e-5, 2e-4),
+	"gemma":    (1e-4, 2e-5),
+	"llama":    (2e-5, 5e-5),
+	"mistral":  (1e-5, 3e-5),
+	"phi3":     (1e-5, 1e-5),
+	"qwen2":    (3e-4, 1e-4),
+	"stablelm": (1e-5, 1e-5),
+}
+
+def test(model, testcase, eps=None):
+	logits, hidden_states = model(np.array([testcase["input_ids"]]))
+	passed = True
+	for key, value, err in zip(["hidden_states", "logits"], [hidden_states, logits],
+			eps or testErrMap[model.config["model_type"]]):
+		error = np.abs(value[0, -1] - np.array(testcase[key], dtype=np.float32))
+		print(f"{key}: L1={error.mean():.3g}, L2={np.sqrt(np.mean(error*error)):.3g}, Li={error.max():.3g}")
+		passed = passed and error.max() < err
+	return passed
+
+def trace_golden(model, golden):
+	# runs the padded prompts of golden.npz at once. right padding doesn't change earlier positions of causal attention
+	model.CacheClear()
+	model.recorded = []
+	try:
+		logits, _ = model(golden["input_ids"])
+		trace = dict(hidden_states=np.stack(model.recorded), argmax=logits.argmax(axis=-1),
+			logits=logits[np.arange(len(logits)), golden["lengths"]-1])
+		if "keys" in golden:
+			trace["keys"] = np.stack([x for name, x in model.cache.items() if name.endswith(".k")])
+			trace["values"] = np.stack([x for name, x in model.cache.items() if name.endswith(".v")])
+	finally:
+		model.recorded = None
+		model.CacheClear()
+	return trace
+
+def compare_golden(golden, trace, tol=1e-2):
+	# returns a dict for each prompt with the first (layer, position) whose max abs error relative to the rms of the
+	# layer exceeds tol, or None if it doesn't diverge
+	valid = np.arange(golden["input_ids"].shape[1]) < golden["lengths"][:, None] # (batch, position)
+	results = [dict(length=int(n)) for n in golden["lengths"]]
+	for key in ["hidden_states", "keys", "values"]:
+		if key not in golden or key not in trace:
+			continue
+		ref = golden[key].astype(np.float32)
+		x = trace[key][..., :ref.shape[-1]].astype(np.float32)
+		if key != "hidden_states": # (layer, batch, head, position, dim) to (layer, batch, position, head*dim)
+			ref, x = [y.transpose(0, 1, 3, 2, 4).reshape(*y.shape[:2], y.shape[3], -1) for y in (ref, x)]
+		scale = np.sqrt(np.mean(ref**2, axis=(1, 2, 3), where=valid[None, :, :, None], keepdims=True))[..., 0]
+		error = np.where(valid, np.abs(x - ref).max(axis=-1) / np.maximum(scale, 1e-12), 0) # (layer, batch, position)
+		diverged = error > tol
+		layer = np.argmax(diverged.any(axis=2), axis=0) # first diverging layer of each prompt
+		position = np.argmax(diverged[layer, np.arange(len(layer))], axis=-1)
+		for i, x in enumerate(results):
+			x[key] = dict(max_error=float(error[:, i].max()), diverged=None if not diverged[:, i].any() else
+				dict(layer=int(layer[i]), position=int(position[i]), error=float(error[layer[i], i, position[i]])))
+	for i, x in enumerate(results):
+		x["argmax"] = float(np.mean(golden["argmax"][i, :x["length"]] == trace["argmax"][i, :x["length"]]))
+		ref = golden["logits"][i].astype(np.float32)
+		x["logits"] = float(np.abs(trace["logits"][i, :len(ref)] - ref).max() / np.sqrt(np.mean(ref**2)))
+	return results
+
+def test_golden(model, golden, tol=1e-2):
+	results = compare_golden(golden, trace_golden(model, golden), tol)
+	print(f"golden: {len(results)} prompts, {golden['hidden_states'].shape[0]} hidden states")
+	passed = True
+	for i, x in enumerate(results):
+		keys = [key for key in ["hidden_states", "keys", "values"] if key in x]
+		status = ", ".join(f"{key} diverges at layer {d['layer']} position {d['position']} (error {d['error']:.3g})"
+			for key in keys if (d := x[key]["diverged"]) is not None) or "ok"
+		passed = passed and status == "ok"
+		print(f"\tprompt {i} ({x['length']} tokens): {status}, max error {max(x[key]['max_error'] for key in keys):.3g},"
+			f" argmax agreement {x['argmax']:.1%}, last logits error {x['logits']:.3g}")
+	return passed
+
+def benchmark(model, batch_size, prompt_len, max_new_tokens):
+	rng = np.random.default_rng(0)
+	input_ids = rng.integers(0, model.config["vocab_size"], (batch_size, prompt_len))
+	model.CacheClear()
+	start = time.perf_counter()
+	logits, _ = model(input_ids)
+	prefill = time.perf_counter()-start
+	next_ids = np.argmax(logits[:, -1], axis=-1)[:, None]
+	start = time.perf_counter()
+	for _ in range(max_new_tokens):
+		logits, _ = model(next_ids)
+		next_ids = np.argmax(logits[:, -1], axis=-1)[:, None]
+	decode = time.perf_counter()-start
+	print(f"prefill: {batch_size*prompt_len/prefill:.1f} tokens/s ({batch_size}x{prompt_len} tokens in {prefill:.3f}s)")
+	print(f"decode:  {batch_size*max_new_tokens/decode:.1f} tokens/s ({batch_size}x{max_new_tokens} tokens in {decode:.3f}s)")
+
+def main():
+	import sys
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('folder', help='exported model folder. for example: ../Model/TinyStories-1M')
+	parser.add_argument('--eps', type=float, nargs=2, help='max error of hidden states and logits against testcase.json')
+	parser.add_argument('--golden', type=str, help='golden.npz to compare every layer against. default: golden.npz in folder if it exists')
+	parser.add_argument('--golden-tol', type=float, default=1e-2, help='max error relative to the rms of a layer in golden.npz')
+	parser.add_argument('--batch-size', type=int, default=1)
+	parser.add_argument('--prompt-len', type=int, default=32)
+	parser.add_argument('--max-new-tokens', type=int, default=32, help='number of tokens to decode in benchmark')
+	args = parser.parse_args()
+
+	start = time.perf_counter()
+	model = from_pretrained(args.folder)
+	model(np.zeros((1, 1), dtype=np.int64)) # load parameters
+	model.CacheClear()
+	print(f"load: {time.perf_counter()-start:.3f}s")
+
+	passed = True
+	if (Path(args.folder)/"testcase.json").exists():
+		with open(Path(args.folder)/"testcase.json") as f:
+			passed = test(model, json.load(f), args.eps)
+		print("test: " + ("passed" if passed else "failed"))
+	golden = args.golden or (Path(args.folder)/"golden.npz")
+	if Path(golden).exists():
+		passed = test_golden(model, np.load(golden), args.golden_tol) and passed
+		print("golden: " + ("passed" if passed else "failed"))
+	if args.max_new_tokens > 0:
+		benchmark(model, args.batch_size, args.prompt_len, args.max_new_tokens)
+	sys.exit(0 if passed else 1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,34 @@
+import pytest
+
+# checks of convert on a tiny gpt2
+
+@pytest.mark.parametrize("parallel", [dict(jobs=2), dict(threads=2)])
+def test_export_parallel_matches_serial(gpt2_folder, tmp_path, parallel):
+	# --jobs and --threads write the same files as the serial path, with quantized and float tensors
+	import torch
+	import convert
+	from transformers import AutoModelForCausalLM
+	model = AutoModelForCausalLM.from_pretrained(gpt2_folder)
+	quantize = lambda name, shape: len(shape) == 2
+	with torch.no_grad():
+		convert.export_lm(model, tmp_path/"serial", quantize=quantize)
+		convert.export_lm(model, tmp_path/"parallel", quantize=quantize, **parallel)
+	files = lambda folder: {x.name: x.read_bytes() for x in sorted(folder.iterdir())}
+	serial = files(tmp_path/"serial")
+	assert any(".q8." in x for x in serial)
+	assert files(tmp_path/"parallel") == serial
+
+def test_convert_plan_logits(gpt2_folder, tmp_path):
+	# the logits of the testcase prompt drive the plan, and the arguments are still recorded in the manifest
+	import json
+	import torch
+	import convert
+	args = convert.parse_args([str(gpt2_folder), str(tmp_path/"model"), "--error-budget", "0.01", "--plan-logits", "--max-positions", "8"])
+	with torch.no_grad():
+		assert convert.convert_model(args) == tmp_path/"model"
+	with open(tmp_path/"model"/"manifest.json") as f:
+		manifest = json.load(f)
+	assert manifest["convert"] == convert.convert_inputs(args)
+	assert (tmp_path/"model"/"quantize_plan.json").exists()
+	assert convert.up_to_date(tmp_path/"model", manifest["convert"])
+
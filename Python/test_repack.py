@@ -0,0 +1,37 @@
+import pytest
+
+# checks of repack against convert on a tiny gpt2
+
+@pytest.mark.parametrize("bits", [8, 4])
+def test_repack_quantize_matches_convert(gpt2_folder, textures, tmp_path, bits):
+	import torch
+	import convert
+	import repack
+	from transformers import AutoModelForCausalLM
+	model = AutoModelForCausalLM.from_pretrained(gpt2_folder)
+	quantize = lambda name, shape: True
+	with torch.no_grad():
+		convert.export_lm(model, tmp_path/"float", force_write=True)
+		convert.export_lm(model, tmp_path/"quantized", force_write=True, quantize=quantize, quantize_bits=bits)
+	repack.repack(tmp_path/"float", tmp_path/"repacked", quantize=quantize, quantize_bits=bits)
+	expected = textures(tmp_path/"quantized")
+	assert any(".q8." in x for x in expected)
+	assert textures(tmp_path/"repacked") == expected
+
+def test_repack_retile_round_trip(gpt2_folder, textures, tmp_path):
+	import torch
+	import convert
+	import repack
+	from transformers import AutoModelForCausalLM
+	model = AutoModelForCausalLM.from_pretrained(gpt2_folder)
+	with torch.no_grad():
+		convert.export_lm(model, tmp_path/"model", force_write=True)
+	repack.repack(tmp_path/"model", tmp_path/"tiled", max_size=16)
+	repack.repack(tmp_path/"tiled", tmp_path/"untiled")
+	assert textures(tmp_path/"tiled") != textures(tmp_path/"model")
+	assert textures(tmp_path/"untiled") == textures(tmp_path/"model")
+
+def test_repack_without_manifest(tmp_path):
+	import repack
+	with pytest.raises(FileNotFoundError, match="re-export"):
+		repack.repack(tmp_path)
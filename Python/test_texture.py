@@ -0,0 +1,13 @@
+import numpy as np
+from texture import pack_atlas
+
+# checks of the texture atlas, which packs 1-D tensors into one texture
+
+def test_pack_atlas_offsets():
+	tensors = [("a", np.arange(3, dtype=np.float32)), ("b", np.arange(4, dtype=np.float16)), ("c", np.ones(9, dtype=np.float32))]
+	row, entries = pack_atlas(tensors)
+	assert entries == [("a", 0, 3), ("b", 4, 4), ("c", 8, 9)]
+	assert row.dtype == np.float32 and len(row) == 20
+	for (name, x), (_, offset, size) in zip(tensors, entries):
+		assert offset % 4 == 0
+		np.testing.assert_array_equal(row[offset:offset+size], x)
@@ -0,0 +1,53 @@
+import pytest
+import tokenizer
+
+# checks of tokenizer.bytes against the original tokenizer, on tiny tokenizers made in the test
+
+def export_tokenizer(hf_tokenizer, folder):
+	convert = pytest.importorskip("convert")
+	convert.export_tokenizer(hf_tokenizer, folder)
+	return tokenizer.Tokenizer.from_file(folder/"tokenizer.bytes")
+
+def test_tokenizer_byte_level(tmp_path):
+	# the merge of a space and the first byte of "é" ranks before the merge of its two bytes, so a word must start
+	# from bytes rather than from the character "é" in vocab
+	tokenizers = pytest.importorskip("tokenizers")
+	from transformers import PreTrainedTokenizerFast
+	from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+	chars = bytes_to_unicode()
+	vocab = {chars[b]: b for b in range(256)}
+	merges = [("Ġ", "Ã"), ("Ã", "©"), ("Ġ", "c"), ("Ġc", "a")]
+	for x, y in merges:
+		vocab[x+y] = len(vocab)
+	tok = tokenizers.Tokenizer(tokenizers.models.BPE(vocab, merges))
+	tok.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+	tok.decoder = tokenizers.decoders.ByteLevel()
+	hf = PreTrainedTokenizerFast(tokenizer_object=tok)
+
+	encoder = export_tokenizer(hf, tmp_path)
+	assert encoder.byte_level
+	text = "é é café cacao 🦄"
+	words = [text[i:j].encode() for _, (i, j) in tok.pre_tokenizer.pre_tokenize_str(text)]
+	assert encoder.encode(words) == hf(text, add_special_tokens=False).input_ids
+	assert encoder.decode(encoder.encode(words)) == text.encode()
+
+def test_tokenizer_byte_fallback(tmp_path):
+	# sentencepiece-like BPE starts from characters, and bytes of characters not in vocab
+	tokenizers = pytest.importorskip("tokenizers")
+	from transformers import PreTrainedTokenizerFast
+	vocab = {"<unk>": 0, **{f"<0x{b:02X}>": 1+b for b in range(256)}}
+	for c in ["▁", "a", "b", "é"]:
+		vocab[c] = len(vocab)
+	merges = [("▁", "a"), ("a", "b"), ("▁a", "b"), ("b", "é")]
+	for x, y in merges:
+		vocab.setdefault(x+y, len(vocab))
+	tok = tokenizers.Tokenizer(tokenizers.models.BPE(vocab, merges, unk_token="<unk>", byte_fallback=True))
+	tok.normalizer = tokenizers.normalizers.Sequence([tokenizers.normalizers.Prepend("▁"), tokenizers.normalizers.Replace(" ", "▁")])
+	tok.decoder = tokenizers.decoders.Sequence([tokenizers.decoders.Replace("▁", " "), tokenizers.decoders.ByteFallback(),
+		tokenizers.decoders.Fuse(), tokenizers.decoders.Strip(" ", 1, 0)])
+	hf = PreTrainedTokenizerFast(tokenizer_object=tok, unk_token="<unk>")
+
+	encoder = export_tokenizer(hf, tmp_path)
+	assert not encoder.byte_level
+	text = "ab abé ßa éb"
+	assert encoder.encode([(" "+text).encode()]) == hf(text, add_special_tokens=False).input_ids
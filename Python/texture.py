@@ -0,0 +1,109 @@
+import os
+os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
+
+import re
+import math
+import time
+import numpy as np
+import cv2
+from pathlib import Path
+
+# texture layout and encoding of exported tensors, shared by convert.py and repack.py without torch
+
+MAX_SIZE = 16384 # max texture width, wider textures are tiled
+ATLAS_MODES = ["model", "layer"]
+
+EXR_CODECS = dict(none=cv2.IMWRITE_EXR_COMPRESSION_NO, rle=cv2.IMWRITE_EXR_COMPRESSION_RLE,
+	zips=cv2.IMWRITE_EXR_COMPRESSION_ZIPS, zip=cv2.IMWRITE_EXR_COMPRESSION_ZIP, piz=cv2.IMWRITE_EXR_COMPRESSION_PIZ)
+PNG_CODECS = {"default": None, **{f"level{i}": i for i in (1, 3, 6, 9)}} # default is level 1 with Z_RLE
+CODEC_POLICIES = ["smallest", "fastest", "balanced"]
+# fixed decode speed rank of each codec, fastest first, so that the choice doesn't depend on timing.
+# png levels inflate at about the same speed
+DECODE_RANK = dict(none=0, rle=1, zip=2, zips=3, piz=4, **{k: 0 for k in PNG_CODECS})
+
+def imwrite_params(data, codec=None):
+	if data.dtype == np.float16 or data.dtype == np.float32:
+		return (
+			cv2.IMWRITE_EXR_TYPE,
+			cv2.IMWRITE_EXR_TYPE_HALF if data.dtype == np.float16 else cv2.IMWRITE_EXR_TYPE_FLOAT,
+			cv2.IMWRITE_EXR_COMPRESSION,
+			EXR_CODECS[codec or "piz"]) # https://aras-p.info/blog/2021/08/04/EXR-Lossless-Compression/
+	elif data.dtype == np.ubyte:
+		return (cv2.IMWRITE_PNG_COMPRESSION, PNG_CODECS[codec]) if PNG_CODECS.get(codec) is not None else ()
+	else:
+		raise NotImplementedError
+
+def imwrite(path, data, codec=None):
+	data = data[..., [2,1,0,3]] # RGBA to BGRA
+	cv2.imwrite(str(path), data.astype(np.float32) if data.dtype == np.float16 else data, imwrite_params(data, codec))
+
+def encode_codecs(data, ext, repeat=3):
+	# encode BGRA data with every lossless codec, returning {codec: (buffer, decode time)}. the time is None if repeat is 0
+	codecs = PNG_CODECS if data.dtype == np.ubyte else EXR_CODECS
+	results = {}
+	for codec in codecs:
+		_, buf = cv2.imencode(ext, data.astype(np.float32) if data.dtype == np.float16 else data, imwrite_params(data, codec))
+		elapsed = math.inf if repeat else None
+		for _ in range(repeat):
+			start = time.perf_counter()
+			cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+			elapsed = min(elapsed, time.perf_counter()-start)
+		results[codec] = (buf, elapsed)
+	return results
+
+def pick_codec(results, policy):
+	# by size and DECODE_RANK only, so that exports are reproducible. ties go to the first codec
+	min_size = min(len(buf) for buf, _ in results.values())
+	return min(results, key=dict(
+		smallest = lambda x: (len(results[x][0]), DECODE_RANK[x]),
+		fastest  = lambda x: (DECODE_RANK[x], len(results[x][0])),
+		balanced = lambda x: len(results[x][0])/min_size + DECODE_RANK[x]/10, # a rank is worth 10% of the smallest size
+	)[policy])
+
+def select_codec(path, data, policy):
+	results = encode_codecs(data[..., [2,1,0,3]], Path(path).suffix, repeat=0) # RGBA to BGRA
+	codec = pick_codec(results, policy)
+	with open(path, "wb") as f:
+		f.write(results[codec][0])
+	return dict(file=Path(path).name, codec=codec, size=len(results[codec][0]),
+		candidates={k: len(buf) for k, (buf, _) in results.items()})
+
+def pad_align(data, align):
+	return np.pad(data, [(0,(-n)%m) for n, m in zip(data.shape, align)])
+
+def pad_tile(array, max_size=MAX_SIZE):
+	if len(array.shape) == 1:
+		array = pad_align(array, [4]).reshape(1, -1, 4)
+	elif len(array.shape) == 2:
+		array = pad_align(array, [1, 4]).reshape(array.shape[0], -1, 4)
+	elif len(array.shape) == 3:
+		array = pad_align(array, [1, 4, 1] if array.shape[-1] == 1 else [1, 1, 4]).reshape(array.shape[0], -1, 4)
+	else:
+		raise KeyError(f"unexpected {array.shape}")
+
+	# tile wide texture
+	if array.shape[1] > max_size:
+		lvl = 0
+		while ((array.shape[1]-1)>>lvl)+1 > max_size:
+			lvl += 1
+		array = pad_align(array, [1, 1<<lvl, 1]).reshape(array.shape[0], -1, 1<<lvl, array.shape[2])\
+			.transpose(0, 2, 1, 3).reshape(array.shape[0]<<lvl, -1, array.shape[2])
+
+	return array[::-1] # flip Y for d3d
+
+def can_quantize(name, shape):
+	return bool(re.search(r"\.weight(\.T)?$", name)) and len(shape) == 2\
+		and not re.search(r"(rotary_emb|pos_embedding|relative_attention_bias)\.weight", name)
+
+def atlas_name(name, mode):
+	# texture of a small tensor packed by mode "model" into one atlas, or by "layer" into an atlas per layer
+	m = re.match(r"(.*?[.]\d+)[.]", name) if mode == "layer" else None
+	return f"{m[1]}.atlas" if m else "atlas"
+
+def pack_atlas(tensors):
+	# concatenate 1-D tensors [(name, array)] in one row, returning the row and [(name, offset, size)] in floats.
+	# offsets are multiples of 4, so that each tensor starts at a texel like a texture of its own
+	dtype = np.result_type(*[x.dtype for _, x in tensors])
+	arrays = [pad_align(x.astype(dtype), [4]) for _, x in tensors]
+	offsets = np.cumsum([0] + [len(x) for x in arrays])
+	return np.concatenate(arrays), [(name, int(offset), len(x)) for (name, x), offset in zip(tensors, offsets)]
@@ -0,0 +1,118 @@
+import numpy as np
+
+# tokenizer.bytes layout, all little-endian uint32 except vocab bytes:
+#   header  [magic, version, vocab_size, merge_count, table_size, flags]
+#   offsets [vocab_size+1] byte offsets of each token in vocab bytes
+#   table   [table_size, 4] open addressing hash table of (left, right, rank, merged), empty if left == EMPTY
+#   vocab bytes
+MAGIC = int.from_bytes(b"SGTK", "little")
+VERSION = 2
+EMPTY = 0xFFFFFFFF
+BYTE_LEVEL = 1 # flag: words start as bytes like byte-level BPE, instead of characters with byte fallback
+
+def merge_hash(left, right):
+	# works on python ints and uint64 arrays
+	h = (left * 0x9E3779B1 + right) * 0x85EBCA6B & 0xFFFFFFFF
+	return h ^ (h >> 16)
+
+def pack_tokenizer(vocab, merges=None, byte_level=False):
+	# vocab: list of bytes, merges: list of (left, right, merged) ids in rank order
+	merges = merges or []
+	table_size = 1 << max(0, (2*len(merges)-1).bit_length())
+	table = np.full((table_size, 4), EMPTY, dtype=np.uint32)
+	if merges:
+		mask = table_size-1
+		pairs = np.array(merges, dtype=np.uint64)
+		slots = (merge_hash(pairs[:, 0], pairs[:, 1]) & mask).tolist()
+		for rank, ((left, right, merged), i) in enumerate(zip(merges, slots)):
+			while table[i, 0] != EMPTY:
+				if table[i, 0] == left and table[i, 1] == right:
+					break # keep the first rank of duplicate pairs
+				i = (i+1) & mask
+			else:
+				table[i] = (left, right, rank, merged)
+
+	offsets = np.zeros(len(vocab)+1, dtype=np.uint32)
+	offsets[1:] = np.cumsum([len(x) for x in vocab])
+	header = np.array([MAGIC, VERSION, len(vocab), len(merges), table_size, BYTE_LEVEL if byte_level else 0], dtype=np.uint32)
+	return b"".join([header.tobytes(), offsets.tobytes(), table.tobytes(), b"".join(vocab)])
+
+class Tokenizer:
+	# reference encoder for tokenizer.bytes. input words must be pre-tokenized and normalized like the original tokenizer
+	def __init__(self, data):
+		data = memoryview(data)
+		magic, version = data[:8].cast("I")
+		assert magic == MAGIC and version == VERSION, "not a tokenizer.bytes file of this version"
+		vocab_size, self.merge_count, table_size, flags = data[8:24].cast("I")
+		self.byte_level = bool(flags & BYTE_LEVEL)
+		begin = 24+4*(vocab_size+1)
+		self.offsets = data[24:begin].cast("I")
+		self.table = data[begin:begin+16*table_size].cast("I")
+		self.vocab = data[begin+16*table_size:]
+		self.mask = table_size-1
+		self.pairs = {}
+
+		# initial symbols are bytes in byte-level BPE, whose merges build multi-byte characters.
+		# otherwise they are single characters, or bytes if the character is not in vocab
+		lengths = np.diff(np.frombuffer(self.offsets, dtype=np.uint32))
+		self.symbols = {}
+		for i in np.flatnonzero((lengths > 0) & (lengths <= (1 if self.byte_level else 4))).tolist():
+			token = bytes(self.vocab[self.offsets[i]:self.offsets[i+1]])
+			if self.byte_level:
+				self.symbols.setdefault(token, i) # base bytes come before added tokens
+			else:
+				self.symbols[token] = i
+
+	@classmethod
+	def from_file(cls, path):
+		with open(path, "rb") as f:
+			return cls(f.read())
+
+	def __len__(self):
+		return len(self.offsets)-1
+
+	def lookup(self, left, right):
+		# returns (rank, merged) or None, memoized because python is slow at probing
+		if (left, right) in self.pairs:
+			return self.pairs[left, right]
+		x = None
+		i = merge_hash(left, right) & self.mask
+		while self.merge_count and self.table[4*i] != EMPTY:
+			if self.table[4*i] == left and self.table[4*i+1] == right:
+				x = self.table[4*i+2], self.table[4*i+3]
+				break
+			i = (i+1) & self.mask
+		self.pairs[left, right] = x
+		return x
+
+	def encode_word(self, word):
+		if self.byte_level:
+			ids = [self.symbols[bytes((b,))] for b in word]
+		else:
+			ids = []
+			for c in word.decode("utf-8", errors="surrogateescape"):
+				c = c.encode("utf-8", errors="surrogateescape")
+				if c in self.symbols:
+					ids.append(self.symbols[c])
+				else:
+					ids.extend(self.symbols[bytes((b,))] for b in c)
+		# merge the leftmost pair of lowest rank until none is left, only looking up pairs next to a merge
+		ranks = [self.lookup(x, y) for x, y in zip(ids, ids[1:])]
+		while True:
+			best = min((x[0], i) for i, x in enumerate(ranks) if x is not None) if any(ranks) else None
+			if best is None:
+				break
+			i = best[1]
+			ids[i:i+2] = [ranks[i][1]]
+			del ranks[i]
+			if i > 0:
+				ranks[i-1] = self.lookup(ids[i-1], ids[i])
+			if i < len(ranks):
+				ranks[i] = self.lookup(ids[i], ids[i+1])
+		return ids
+
+	def encode(self, words):
+		return [x for word in words for x in self.encode_word(word)]
+
+	def decode(self, ids):
+		return b"".join(self.vocab[self.offsets[i]:self.offsets[i+1]] for i in ids)
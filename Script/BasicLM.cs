@@ -13,6 +13,7 @@ public class BasicLM : MonoBehaviour {
 	public TextAsset configJson;
 	public TextAsset tokenizerJson;
 	public TextAsset testcaseJson;
+	public TextAsset aliasesJson;
 	public GenerationConfig generationConfig;
 	public int encoderMaxLength = 2048;
 
@@ -43,7 +44,7 @@ public class BasicLM : MonoBehaviour {
 			ctx = new TensorContext(),
 			kernels = shaders.ToDictionary(x => x.name.Split('/')[1], x => x),
 		};
-		model = AutoModelForCausalLM.FromPretrained(nn, configJson, textures);
+		model = AutoModelForCausalLM.FromPretrained(nn, configJson, textures, aliasesJson);
 		model.generation_config = generationConfig;
 		tokenizer = JsonUtility.FromJson<Tokenizer>(tokenizerJson.text);
 		var testcase = testcaseJson ? JsonUtility.FromJson<Testcase>(testcaseJson.text) : null;
@@ -85,7 +86,7 @@ public class BasicLM : MonoBehaviour {
 	}
 	public void Update() {
 		if(task == Task.Run) {
-			if(tokens.Count >= generationConfig.max_length)
+			if(tokens.Count >= model.max_length)
 				return;
 			if(Time.time < nextTime)
 				return;
@@ -13,6 +13,7 @@ public class BasicTTS : MonoBehaviour {
 	public TextAsset configJson;
 	public TextAsset tokenizerJson;
 	public TextAsset testcaseJson;
+	public TextAsset aliasesJson;
 
 	public enum Task {
 		Run = 0,
@@ -38,7 +39,7 @@ public class BasicTTS : MonoBehaviour {
 			kernels = shaders.ToDictionary(x => x.name.Split('/')[1], x => x),
 		};
 		model = new Models.Vits(nn, Models.VitsConfig.FromPretrained(configJson));
-		model.LoadStateDict(textures);
+		model.LoadStateDict(textures, aliasesJson);
 		tokenizer = JsonUtility.FromJson<Tokenizer>(tokenizerJson.text);
 		var testcase = testcaseJson ? JsonUtility.FromJson<Testcase>(testcaseJson.text) : null;
 
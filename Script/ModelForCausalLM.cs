@@ -19,7 +19,7 @@ public abstract class ModelForCausalLM<T> : PretrainedModel<T>, ModelForCausalLM
 	}
 	public abstract (Texture logits, Texture hidden_states) ForCausalLM(Texture input_ids);
 
-	private int max_length => generation_config.max_length;
+	public int max_length => config.max_positions > 0 ? Mathf.Min(generation_config.max_length, config.max_positions) : generation_config.max_length;
 	private float temperature => generation_config.do_sample ? generation_config.temperature : 0f;
 	private float repetition_penalty => generation_config.repetition_penalty;
 	void RepetitionPenaltyLogitsProcessor(Texture input_ids, ref Texture scores, float penalty, Texture last_input_ids) {
@@ -62,6 +62,7 @@ public abstract class ModelForCausalLM<T> : PretrainedModel<T>, ModelForCausalLM
 public interface ModelForCausalLM : PretrainedModel {
 	/*public*/ GenerationConfig generation_config {get;set;}
 	/*public*/ Dictionary<string,RenderTexture> cache {get;set;}
+	/*public*/ int max_length {get;} // generation_config.max_length clamped to config.max_positions
 	/*public*/ (Texture logits, Texture hidden_states) ForCausalLM(Texture input_ids);
 	/*public*/ Texture Generate(Texture input, ref Texture scores);
 	/*public*/ void CacheClear();
@@ -104,9 +105,9 @@ public static class AutoModelForCausalLM {
 			throw new System.NotSupportedException($"unsupported architecture \"{config.model_type}\"");
 		}
 	}
-	public static ModelForCausalLM FromPretrained(TensorNN nn, TextAsset configJson, Texture[] textures) {
+	public static ModelForCausalLM FromPretrained(TensorNN nn, TextAsset configJson, Texture[] textures, TextAsset aliasesJson=null) {
 		var model = FromPretrained(nn, configJson);
-		model.LoadStateDict(textures);
+		model.LoadStateDict(textures, aliasesJson);
 		return model;
 	}
 }
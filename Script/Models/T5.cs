@@ -52,7 +52,7 @@ public class T5 : ModelForSeq2SeqLM<T5Config> {
 
 		var attn_scores = BatchRelease(nn.Linear(MarkRelease(query), use_cache?keys:MarkRelease(keys), heads:config.num_attention_heads));
 		if(!cross) {
-			var window_size = config.relative_attention_max_distance;
+			var window_size = config.max_positions > 0 ? Mathf.Min(config.relative_attention_max_distance, config.max_positions) : config.relative_attention_max_distance;
 			var position_bias = nn.Narrow(state_dict[Regex.Replace($"{path}.relative_attention_bias.weight.T", @"[.]\d+[.]", ".0.")],
 				window:(new Vector4(window_size, window_size+ksize0, -1, 1), input_ids),
 				groups:config.num_attention_heads, size0:qsize0, clamp:true);
@@ -77,7 +77,7 @@ public class T5 : ModelForSeq2SeqLM<T5Config> {
 		hidden_states = BatchRelease(Linear($"{path}.wo", MarkRelease(hidden_states)));
 	}
 	void T5Block(string path, ref Texture hidden_states, Texture input_ids, Texture encoder_hidden_states=null) {
-		var is_decoder = state_dict.ContainsKey($"{path}.layer.2.layer_norm.weight");
+		var is_decoder = HasTensor($"{path}.layer.2.layer_norm.weight");
 		// when hidden_states is null, only compute cross attn kv
 		if(hidden_states) {
 			var attn_states = LayerNorm($"{path}.layer.0.layer_norm", hidden_states, config.rms_norm_eps, rms:true);
@@ -33,9 +33,9 @@ public class Vits : PretrainedModel<VitsConfig> {
 	public VitsFlow flow;
 	public VitsDecoder decoder;
 	public Vits(TensorNN nn, VitsConfig config): base(nn, config) {
-		text_encoder = new VitsEncoder(nn, config){state_dict=state_dict};
-		flow = new VitsFlow(nn, config){state_dict=state_dict};
-		decoder = new VitsDecoder(nn, config){state_dict=state_dict};
+		text_encoder = new VitsEncoder(nn, config){state_dict=state_dict, atlas=atlas};
+		flow = new VitsFlow(nn, config){state_dict=state_dict, atlas=atlas};
+		decoder = new VitsDecoder(nn, config){state_dict=state_dict, atlas=atlas};
 	}
 	public (Texture waveform, Texture spectrogram, Texture hidden_states) VitsModel(Texture input_ids, Texture indices,
 			(Vector4,Texture)? input_padding_mask=null, (Vector4,Texture)? output_padding_mask=null) {
@@ -6,12 +6,14 @@ public abstract class Module {
 	protected TensorNN nn;
 	protected TensorContext ctx => nn.ctx;
 	public Dictionary<string, Texture> state_dict;
+	public Dictionary<string, TexView> atlas; // small tensors packed in atlas textures
 
 	public Module(TensorNN nn) {
 		this.nn = nn;
 		this.state_dict = new Dictionary<string, Texture>();
+		this.atlas = new Dictionary<string, TexView>();
 	}
-	public void LoadStateDict(IEnumerable<Texture> textures) {
+	public virtual void LoadStateDict(IEnumerable<Texture> textures, TextAsset aliasesJson=null) {
 		foreach(var tex in textures)
 			state_dict[tex.name] = tex;
 		foreach(var tex in textures) {
@@ -20,9 +22,23 @@ public abstract class Module {
 			if(state_dict.TryGetValue(tex.name+".q8.idx", out var permuter))
 				nn.permuters[tex] = permuter;
 		}
+		if(aliasesJson) // identical tensors share textures
+			foreach(var alias in JsonUtility.FromJson<StateDictAliases>(aliasesJson.text).aliases)
+				foreach(var suffix in new[]{"", ".q8", ".q8.idx"})
+					if(state_dict.TryGetValue(alias.target+suffix, out var tex))
+						state_dict[alias.name+suffix] = tex;
 	}
 
 	// utilities
+	protected bool HasTensor(string name) => state_dict.ContainsKey(name) || atlas.ContainsKey(name);
+	protected TexView Tensor(string name) => atlas.TryGetValue(name, out var view) ? view : state_dict[name];
+	protected bool TryGetTensor(string name, out TexView tensor) {
+		if(atlas.TryGetValue(name, out tensor))
+			return true;
+		var found = state_dict.TryGetValue(name, out var tex);
+		tensor = tex;
+		return found;
+	}
 	List<Texture> releaseList = new List<Texture>();
 	protected T MarkRelease<T>(T tex) where T: Texture {
 		releaseList.Add(tex);
@@ -54,26 +70,44 @@ public abstract class Module {
 		if(fallback != null && !state_dict.ContainsKey($"{path}.weight.T") && !state_dict.ContainsKey($"{path}.weight"))
 			path = fallback;
 		state_dict.TryGetValue($"{path}.weight.T", out var weightT);
-		state_dict.TryGetValue($"{path}.bias", out var bias);
+		TryGetTensor($"{path}.bias", out var bias);
 		return nn.Linear(input, weightT ?? state_dict[$"{path}.weight"], bias, weightT:weightT);
 	}
 	protected Texture Conv1d(string path, TexView input, int kernel_size, int stride=1, int dilation=1) {
-		state_dict.TryGetValue($"{path}.bias", out var bias);
+		TryGetTensor($"{path}.bias", out var bias);
 		return nn.Conv1d(input, state_dict[$"{path}.weight"], bias, kernel_size, stride:stride, dilation:dilation);
 	}
 	protected Texture ConvTranspose1d(string path, TexView input, int kernel_size, int stride=1) {
-		state_dict.TryGetValue($"{path}.bias", out var bias);
+		TryGetTensor($"{path}.bias", out var bias);
 		return nn.ConvTranspose1d(input, state_dict[$"{path}.weight"], bias, kernel_size, stride:stride);
 	}
 	protected Texture LayerNorm(string path, TexView input, float eps, int groups=1, bool rms=false) {
-		state_dict.TryGetValue($"{path}.bias", out var bias);
-		return nn.GroupNorm(input, state_dict[$"{path}.weight"], bias, eps, groups:groups, rms:rms);
+		TryGetTensor($"{path}.bias", out var bias);
+		return nn.GroupNorm(input, Tensor($"{path}.weight"), bias, eps, groups:groups, rms:rms);
+	}
+}
+[System.Serializable]
+public class StateDictAliases {
+	public Alias[] aliases;
+	[System.Serializable]
+	public class Alias {
+		public string name;
+		public string target;
 	}
 }
 [System.Serializable]
+public class AtlasEntry {
+	public string name;
+	public string texture;
+	public int offset; // in floats, a multiple of 4
+	public int size;
+}
+[System.Serializable]
 public class PretrainedConfig {
 	public string model_type;
 	public int vocab_size;
+	public int max_positions; // context length of exported position tables, 0 if not limited
+	public AtlasEntry[] atlas; // 1-D tensors packed by convert.py --atlas
 }
 public abstract class PretrainedConfig<S> : PretrainedConfig where S : PretrainedConfig<S> {
 	public static S FromPretrained(TextAsset configJson) {
@@ -86,9 +120,18 @@ public abstract class PretrainedModel<T> : Module, PretrainedModel where T : Pre
 	public PretrainedModel(TensorNN nn, T config): base(nn) {
 		this.config = config;
 	}
+	public override void LoadStateDict(IEnumerable<Texture> textures, TextAsset aliasesJson=null) {
+		base.LoadStateDict(textures, aliasesJson);
+		if(config.atlas != null)
+			foreach(var entry in config.atlas) { // an atlas is one row of tensors
+				var tex = state_dict[entry.texture];
+				ctx.FixSize0(tex, 1);
+				atlas[entry.name] = new TexView(tex, 1, (entry.size+3)/4, 0, entry.offset/4);
+			}
+	}
 }
 public interface PretrainedModel {
 	/*public*/ string model_type {get;}
-	/*public*/ void LoadStateDict(IEnumerable<Texture> textures);
+	/*public*/ void LoadStateDict(IEnumerable<Texture> textures, TextAsset aliasesJson=null);
 }
 }
\ No newline at end of file
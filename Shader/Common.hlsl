@@ -48,6 +48,7 @@ float4 sigmoid(float4 x) {
 float4 dequantizeWeight(float4 x, float offset) {
 #if defined(WEIGHT_QUANTIZED_S24_Z8)
 	// weight == (weight_u8 - zero_u8) / 256 * scale_f24
+	// 4-bit weights are stored as weight_u4*17, which is exact in unorm4 textures
 	return x*255 - offset;
 #elif defined(WEIGHT_QUANTIZED_E8)
 	// weight == (weight_u8 - (weight_u8 > max_u8 ? 255 : 0)) / 256 * exp2(exp_i8 * 0.5)
@@ -100,5 +101,6 @@ uint4 getThreadIdAndGroupSize(float4 screenPos, uint4 dim) {
 float4 loadTensor(Texture2D<float4> tex, uint4 dim, uint2 ij) {
 	return tex.mips[dim.w][uint2(ij.y>>dim.z, (ij.y & ((1<<dim.z)-1)) | (ij.x<<dim.z))];
 }
+// _ST.zw is the offset of a view, such as a slice or a small tensor in an atlas texture, which may be tiled
 #define LOAD_TENSOR(name, ij) loadTensor(name##Tex, name##Dim, name##Tex_ST.zw+ij)
 #define DEFINE_TEXTURE2D(name) Texture2D<float4> name; int4 name##_ST;
\ No newline at end of file
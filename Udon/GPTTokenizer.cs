@@ -8,6 +8,7 @@ namespace ShaderGPT.Udon {
 public class GPTTokenizer : UdonMonoBehaviour {
 	[Header("Tokenizer")]
 	public TextAsset tokenizerJson;
+	public TextAsset tokenizerBytes; // optional, replaces the vocab and merges of tokenizer.json in BPE models
 
 	private string[] added_tokens;
 	private string[] vocab;
@@ -17,15 +18,21 @@ public class GPTTokenizer : UdonMonoBehaviour {
 	[System.NonSerialized] public int eos_token_id;
 	[System.NonSerialized] public int unk_token_id;
 	void LoadTokenizer() {
+		if(tokenizerBytes != null)
+			LoadTokenizerBytes();
+		// tokenizer.json still holds added tokens, special token ids and unigram weights.
+		// its vocab and merges are only converted to arrays without tokenizer.bytes, or for unigram
 #if UDON
 		VRCJson.TryDeserializeFromJson(tokenizerJson.text, out var tokenizer);
 		added_tokens = tokenizer.GetStringArray(nameof(added_tokens));
-		vocab        = tokenizer.GetStringArray(nameof(vocab));
-		merges       = tokenizer.GetStringArray(nameof(merges));
 		weights      = tokenizer.GetFloatArray (nameof(weights));
 		bos_token_id = tokenizer.GetInt        (nameof(bos_token_id), -1);
 		eos_token_id = tokenizer.GetInt        (nameof(eos_token_id), -1);
 		unk_token_id = tokenizer.GetInt        (nameof(unk_token_id), -1);
+		if(tokenizerData == null || (weights != null && weights.Length > 0)) {
+			vocab  = tokenizer.GetStringArray(nameof(vocab));
+			merges = tokenizer.GetStringArray(nameof(merges));
+		}
 #else
 		var tokenizer = JsonUtility.FromJson<Tokenizer>(tokenizerJson.text);
 		added_tokens = tokenizer.added_tokens;
@@ -35,7 +42,16 @@ public class GPTTokenizer : UdonMonoBehaviour {
 		bos_token_id = tokenizer.bos_token_id;
 		eos_token_id = tokenizer.eos_token_id;
 		unk_token_id = tokenizer.unk_token_id;
+#endif
+		if(tokenizerData == null)
+			vocabSize = vocab.Length;
+		else if(added_tokens != null) {
+			addedTokenIds = new int[added_tokens.Length];
+			for(int i=0; i<added_tokens.Length; i++)
+				addedTokenIds[i] = FindToken(System.Text.Encoding.UTF8.GetBytes(added_tokens[i]));
+		}
 	}
+#if !UDON
 	[System.Serializable]
 	class Tokenizer {
 		public string[] added_tokens;
@@ -45,36 +61,159 @@ public class GPTTokenizer : UdonMonoBehaviour {
 		public int bos_token_id = -1;
 		public int eos_token_id = -1;
 		public int unk_token_id = -1;
+	}
 #endif
+
+	// tokenizer.bytes, read in place: a header of uint32 [magic, version, vocab_size, merge_count, table_size, flags],
+	// vocab_size+1 byte offsets into the packed vocab, and a hash table of uint32 (left, right, rank, merged) per slot
+	const int TOKENIZER_MAGIC = 0x4B544753; // "SGTK"
+	const int TOKENIZER_VERSION = 2;
+	const int BYTE_LEVEL = 1;
+	private byte[] tokenizerData;
+	private int vocabSize;
+	private bool byteLevel;
+	private int offsetStart;
+	private int tableStart;
+	private int tableMask;
+	private int vocabStart;
+	private long[] symbolKeys; // initial symbols of a word by their bytes, see SymbolKey
+	private int [] symbolIds;  // id+1, or 0 for an empty slot
+	private int [] addedTokenIds;
+	void LoadTokenizerBytes() {
+		var data = tokenizerBytes.bytes;
+		if(ReadInt(data, 0) != TOKENIZER_MAGIC || ReadInt(data, 4) != TOKENIZER_VERSION) {
+			Debug.LogError("tokenizer.bytes is not of this version, using tokenizer.json");
+			return;
+		}
+		vocabSize   = ReadInt(data, 8);
+		tableMask   = ReadInt(data, 16)-1;
+		byteLevel   = (ReadInt(data, 20) & BYTE_LEVEL) != 0;
+		offsetStart = 24;
+		tableStart  = offsetStart + 4*(vocabSize+1);
+		vocabStart  = tableStart + 16*(tableMask+1);
+		tokenizerData = data;
+
+		// initial symbols are bytes in byte-level BPE, whose merges build multi-byte characters.
+		// otherwise they are single characters, or bytes if the character is not in vocab
+		var maxLength = byteLevel ? 1 : 4;
+		var count = 0;
+		for(int i=0; i<vocabSize; i++) {
+			var length = TokenEnd(i) - TokenStart(i);
+			if(0 < length && length <= maxLength)
+				count ++;
+		}
+		var size = 1;
+		while(size < 2*count)
+			size <<= 1;
+		symbolKeys = new long[size];
+		symbolIds  = new int [size];
+		for(int i=0; i<vocabSize; i++) {
+			var start = TokenStart(i);
+			var length = TokenEnd(i) - start;
+			if(length <= 0 || length > maxLength)
+				continue;
+			var key = SymbolKey(data, start, length);
+			var slot = FindSymbolSlot(key);
+			if(symbolIds[slot] == 0 || !byteLevel) { // base bytes come before added tokens
+				symbolKeys[slot] = key;
+				symbolIds[slot] = i+1;
+			}
+		}
+	}
+	static int ReadInt(byte[] data, int i) {
+		return data[i] | data[i+1] << 8 | data[i+2] << 16 | data[i+3] << 24;
+	}
+	int TokenStart(int token) {
+		return vocabStart + ReadInt(tokenizerData, offsetStart + 4*token);
+	}
+	int TokenEnd(int token) {
+		return vocabStart + ReadInt(tokenizerData, offsetStart + 4*token+4);
+	}
+	static uint MergeHash(int left, int right) {
+		// same as merge_hash in tokenizer.py
+		var h = ((uint)left * 0x9E3779B1u + (uint)right) * 0x85EBCA6Bu;
+		return h ^ (h >> 16);
+	}
+	static long SymbolKey(byte[] bytes, int start, int length) {
+		// up to 4 bytes and the length
+		var packed = 0;
+		for(int i=0; i<length; i++)
+			packed |= bytes[start+i] << (8*i);
+		return (long)length << 32 | (uint)packed;
+	}
+	int FindSymbolSlot(long key) {
+		var mask = symbolKeys.Length-1;
+		var slot = (int)(MergeHash((int)key, (int)(key >> 32)) & (uint)mask);
+		while(symbolIds[slot] != 0 && symbolKeys[slot] != key)
+			slot = (slot+1) & mask;
+		return slot;
+	}
+	int FindSymbol(byte[] bytes, int start, int length) {
+		return symbolIds[FindSymbolSlot(SymbolKey(bytes, start, length))]-1;
+	}
+	int FindMerge(int left, int right) {
+		// byte position of the table entry of a pair, or -1
+		var slot = (int)(MergeHash(left, right) & (uint)tableMask);
+		while(true) {
+			var entry = tableStart + 16*slot;
+			var entryLeft = ReadInt(tokenizerData, entry);
+			if(entryLeft == -1) // empty
+				return -1;
+			if(entryLeft == left && ReadInt(tokenizerData, entry+4) == right)
+				return entry;
+			slot = (slot+1) & tableMask;
+		}
+	}
+	int FindToken(byte[] bytes) {
+		// first id of a token in the packed vocab, once per added token
+		for(int i=0; i<vocabSize; i++) {
+			var start = TokenStart(i);
+			if(TokenEnd(i) - start != bytes.Length)
+				continue;
+			var j = 0;
+			while(j < bytes.Length && tokenizerData[start+j] == bytes[j])
+				j ++;
+			if(j == bytes.Length)
+				return i;
+		}
+		return -1;
 	}
 
 	public void OnEnable() {
-		if(vocab == null)
+		if(vocabSize == 0)
 			LoadTokenizer();
 	}
 
 	[System.NonSerialized] public int decodeState;
 	public string Decode(int token) {
-		if(token < 0 || token >= vocab.Length)
+		if(token < 0 || token >= vocabSize)
 			return string.Format("<error:{0}>", token);
-		var s = vocab[token];
-		var n = s.Length;
 		var text = "";
-		for(int i=0; i<n; i++) {
-			var b = char.ConvertToUtf32(s, i);
-			if(b <= 0b01111111)
-				text += char.ConvertFromUtf32(b);
-			else if(b > 0b10111111)
-				decodeState = b;
-			else {
-				decodeState = (decodeState << 6) | (0b00111111 & b);
-				if((decodeState & -0x800) == 0x3000)
-					text += char.ConvertFromUtf32(decodeState - 0x3000);
-				else if((decodeState & -0x10000) == 0xe0000)
-					text += char.ConvertFromUtf32(decodeState - 0xe0000);
-				else if((decodeState & -0x200000) == 0x3c00000)
-					text += char.ConvertFromUtf32(decodeState - 0x3c00000);
-			}
+		if(tokenizerData != null) {
+			var end = TokenEnd(token);
+			for(int i=TokenStart(token); i<end; i++)
+				text = DecodeByte(text, tokenizerData[i]);
+		} else {
+			var s = vocab[token];
+			var n = s.Length;
+			for(int i=0; i<n; i++)
+				text = DecodeByte(text, char.ConvertToUtf32(s, i));
+		}
+		return text;
+	}
+	private string DecodeByte(string text, int b) {
+		if(b <= 0b01111111)
+			text += char.ConvertFromUtf32(b);
+		else if(b > 0b10111111)
+			decodeState = b;
+		else {
+			decodeState = (decodeState << 6) | (0b00111111 & b);
+			if((decodeState & -0x800) == 0x3000)
+				text += char.ConvertFromUtf32(decodeState - 0x3000);
+			else if((decodeState & -0x10000) == 0xe0000)
+				text += char.ConvertFromUtf32(decodeState - 0xe0000);
+			else if((decodeState & -0x200000) == 0x3c00000)
+				text += char.ConvertFromUtf32(decodeState - 0x3c00000);
 		}
 		return text;
 	}
@@ -87,10 +226,10 @@ public class GPTTokenizer : UdonMonoBehaviour {
 		var textLen = text.Length;
 		for(int i=0; i<textLen; ) {
 			var j = textLen;
-			var token = default(string);
+			var token = -1;
 			if(added_tokens != null)
-				foreach(var t in added_tokens) {
-					var k = text.IndexOf(t, i) & 0x7FFFFFFF;
+				for(int t=0; t<added_tokens.Length; t++) {
+					var k = text.IndexOf(added_tokens[t], i) & 0x7FFFFFFF;
 					if(k < j) {
 						j = k;
 						token = t;
@@ -100,13 +239,15 @@ public class GPTTokenizer : UdonMonoBehaviour {
 				var k = PreTokenize(text, i, j);
 				if(weights != null && weights.Length > 0)
 					UnigramEncode(System.Text.Encoding.UTF8.GetBytes(text, i, k-i));
+				else if(tokenizerData != null)
+					BytePairEncodeIds(System.Text.Encoding.UTF8.GetBytes(text, i, k-i));
 				else
 					BytePairEncode(System.Text.Encoding.UTF8.GetBytes(text, i, k-i));
 				i = k;
 			}
-			if(token != null) {
-				tokenArray[tokenCount++] = System.Array.IndexOf(vocab, token);
-				i += token.Length;
+			if(token >= 0) {
+				tokenArray[tokenCount++] = tokenizerData != null ? addedTokenIds[token] : System.Array.IndexOf(vocab, added_tokens[token]);
+				i += added_tokens[token].Length;
 			}
 		}
 		return Take(tokenArray, tokenCount);
@@ -152,6 +293,56 @@ public class GPTTokenizer : UdonMonoBehaviour {
 			System.Array.Copy(parts, minPos+1, parts, minPos, n-minPos);
 		}
 	}
+	private int[] partIdArray = new int[MAX_TOKENS];
+	private int[] pairArray = new int[MAX_TOKENS];
+	private void BytePairEncodeIds(byte[] bytes) {
+		// BytePairEncode on ids of tokenizer.bytes, with hash lookups of merges
+		var n = bytes.Length;
+		var ids = partIdArray;
+		var count = 0;
+		for(int i=0; i<n; i++) {
+			var b = bytes[i];
+			var k = byteLevel ? 1 : b >= 0b11110000 ? 4 : b >= 0b11100000 ? 3 : b >= 0b11000000 ? 2 : 1;
+			var id = k > 1 && i+k <= n ? FindSymbol(bytes, i, k) : -1;
+			if(id >= 0) // prefer full codepoint
+				i += k-1;
+			else { // byte fallback
+				id = FindSymbol(bytes, i, 1);
+				if(id < 0)
+					id = unk_token_id;
+			}
+			ids[count++] = id;
+		}
+		// merge the leftmost pair of lowest rank until none is left, only looking up pairs next to a merge
+		var pairs = pairArray; // pairs[i] is the table entry of (ids[i-1], ids[i])
+		for(int i=1; i<count; i++)
+			pairs[i] = FindMerge(ids[i-1], ids[i]);
+		while(true) {
+			var minRank = 0x7FFFFFFF;
+			var minPos = -1;
+			for(int i=1; i<count; i++) {
+				if(pairs[i] < 0)
+					continue;
+				var rank = ReadInt(tokenizerData, pairs[i]+8);
+				if(rank < minRank) {
+					minRank = rank;
+					minPos = i;
+				}
+			}
+			if(minPos < 0)
+				break;
+			ids[minPos-1] = ReadInt(tokenizerData, pairs[minPos]+12);
+			count--;
+			System.Array.Copy(ids, minPos+1, ids, minPos, count-minPos);
+			System.Array.Copy(pairs, minPos+1, pairs, minPos, count-minPos);
+			if(minPos > 1)
+				pairs[minPos-1] = FindMerge(ids[minPos-2], ids[minPos-1]);
+			if(minPos < count)
+				pairs[minPos] = FindMerge(ids[minPos-1], ids[minPos]);
+		}
+		System.Array.Copy(ids, 0, tokenArray, tokenCount, count);
+		tokenCount += count;
+	}
 	private void UnigramEncode(byte[] bytes) {
 		var n = bytes.Length;
 		var chars = new char[n];